@@ -0,0 +1,122 @@
+"""Transfer of large files through `TrackStream.store`, reading the
+stream in order versus fetching several chunks at the same time
+(PARALLEL_CHUNKS), from a fake CDN with a latency per chunk request and
+a bandwidth per connection (see fakes.py).
+Checks that every mode writes the file of the stream, also when chunk
+requests fail (--errors, parallel modes only: Librespot drops the failed
+chunks, which are requested again once late), and when a parallel transfer
+is interrupted and resumed.
+
+Usage: python -m benchmarks.bench_chunks [--size MB] [--latency MS]
+    [--bandwidth MB/s] [--parallel N ...] [--errors RATE]
+"""
+
+import argparse
+import hashlib
+import logging
+import tempfile
+import time
+from dataclasses import replace
+from pathlib import Path
+
+from benchmarks.fakes import SPOTIFY_HEADER_SIZE, FakeChunkedStream, Profile, fake_flac
+from src import track_dataclass
+from src.track_dataclass import Track, TrackStream
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", type=float, default=40, help="MB per file")
+    parser.add_argument("--latency", type=float, default=50, help="ms per chunk")
+    parser.add_argument(
+        "--bandwidth", type=float, default=4, help="MB/s per connection"
+    )
+    parser.add_argument(
+        "--parallel", type=int, nargs="+", default=[4, 8, 16], help="chunks at once"
+    )
+    parser.add_argument(
+        "--errors", type=float, default=0.0, help="failed chunk requests (0-1)"
+    )
+    return parser.parse_args()
+
+
+def store(data: bytes, profile: Profile, parallel: int, title: str) -> TrackStream:
+    track_dataclass.PARALLEL_CHUNKS = parallel
+    track = Track(id="0" * 22, title=title)
+    source = FakeChunkedStream(data, profile, SPOTIFY_HEADER_SIZE)
+    stream = TrackStream(track, source, ".flac")
+    stream.store()
+    return stream
+
+
+def bench(data: bytes, profile: Profile, parallel: int) -> str:
+    start = time.perf_counter()
+    stream = store(data, profile, parallel, f"parallel {parallel}")
+    elapsed = time.perf_counter() - start
+
+    path = stream.path
+    size = path.stat().st_size
+    mode = f"{parallel} chunks at once" if parallel else "in order"
+    errors = f", {stream.source.errors} failed" if stream.source.errors else ""
+    print(
+        f"{mode:<20} {elapsed:>7.2f}s {size / elapsed / 1e6:>7.1f} MB/s "
+        f"{elapsed * 1000 / stream.source.chunks():>7.1f} ms/chunk{errors}"
+    )
+    return hashlib.sha256(path.read_bytes()).hexdigest()
+
+
+def interrupted(data: bytes, profile: Profile, parallel: int) -> str:
+    """Parallel transfer failing with holes in the file, then resumed."""
+    failing = replace(profile, chunk_error_rate=0.2)
+    retry_after = track_dataclass.CHUNK_RETRY_AFTER
+    timeout = track_dataclass.CHUNK_TIMEOUT
+    track_dataclass.CHUNK_RETRY_AFTER = float("inf")  # Failed chunks never come
+    track_dataclass.CHUNK_TIMEOUT = 1
+    try:
+        store(data, failing, parallel, "interrupted")
+    except TimeoutError:
+        pass
+    else:
+        raise SystemExit("The transfer should have been interrupted")
+    finally:
+        track_dataclass.CHUNK_RETRY_AFTER = retry_after
+        track_dataclass.CHUNK_TIMEOUT = timeout
+
+    part_path = next(track_dataclass.TRACK_FOLDER.rglob("*.part"))
+    progress = track_dataclass.read_progress(part_path.with_suffix(".progress"))
+    print(f"Interrupted {parallel} chunks at once transfer, {progress} bytes complete")
+
+    stream = store(data, profile, parallel, "interrupted")
+    if stream.path.with_name(f"{stream.path.name}.progress").exists():
+        raise SystemExit("The progress of the resumed transfer was kept")
+    print("Resumed from there")
+    return hashlib.sha256(stream.path.read_bytes()).hexdigest()
+
+
+def main() -> None:
+    args = parse_args()
+    profile = Profile(chunk_latency=args.latency / 1000, bandwidth=args.bandwidth * 1e6)
+    failing = replace(profile, chunk_error_rate=args.errors)
+    data = bytes(SPOTIFY_HEADER_SIZE) + fake_flac(int(args.size * 1e6))
+    # Tags are not the point here, and need the cover cache
+    track_dataclass.IN_STREAM_TAGGING = False
+    # Failed chunks requested again after a few latencies
+    track_dataclass.CHUNK_RETRY_AFTER = 4 * profile.chunk_latency
+    logging.getLogger().setLevel(logging.WARNING)
+
+    print(
+        f"{args.size:.0f} MB file, {args.latency:.0f} ms per chunk request, "
+        f"{args.bandwidth:.1f} MB/s per connection"
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        track_dataclass.TRACK_FOLDER = Path(folder)
+        hashes = {bench(data, profile, 0)}
+        hashes |= {bench(data, failing, parallel) for parallel in args.parallel}
+        hashes.add(interrupted(data, profile, max(args.parallel)))
+    expected = hashlib.sha256(data[SPOTIFY_HEADER_SIZE:]).hexdigest()
+    if hashes != {expected}:
+        raise SystemExit("Files differ from the stream")
+
+
+if __name__ == "__main__":
+    main()
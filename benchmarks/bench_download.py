@@ -0,0 +1,233 @@
+"""End to end downloads through `spotify_dl.request`, against offline
+stand-ins of Librespot, the Web API and the cover CDN (see fakes.py).
+Each scenario runs with cold caches (metadata and covers), then warm ones.
+Downloaded tracks are deleted between runs, so both runs download everything.
+
+Usage: python -m benchmarks.bench_download [scenario..] [--json FILE]
+    [--track-size KB] [--bandwidth MB/s] [--rate-limits]
+    [--catalog FILE] [--save-catalog FILE]
+Scenarios: track, album, playlist, playlist-web-api, artist (all by default).
+Playlists go through the Librespot metadata path (LIBRESPOT_METADATA),
+playlist-web-api resolves the same playlist through the Web API.
+Rate limits are disabled unless --rate-limits is given, to measure the code
+rather than the pacing of Spotify's limits.
+The Web API JSON is generated, or loaded with --catalog (a catalog saved
+with --save-catalog, or made of recorded tracks, albums and playlists).
+"""
+
+import argparse
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+from benchmarks.fakes import (
+    Catalog,
+    FakeHTTPSession,
+    FakeLibrespot,
+    FakeSpotify,
+    Profile,
+)
+from config import LIBRESPOT_METADATA
+
+# Name: (element type, number of tracks, or of releases for an artist)
+SCENARIOS = {
+    "track": ("track", 1),
+    "album": ("album", 50),
+    "playlist": ("playlist", 2000),
+    "playlist-web-api": ("playlist", 2000),
+    "artist": ("artist", 40),  # Releases, 20 albums and 20 singles
+}
+# Histograms reported per stage
+REPORTED = [
+    "spotifydl_web_api_seconds",
+    "spotifydl_stage_seconds",
+    "spotifydl_pipeline_seconds",
+    "spotifydl_queue_depth",
+]
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("scenarios", nargs="*", help=", ".join(SCENARIOS))
+    parser.add_argument("--json", type=Path, help="write the results to a file")
+    parser.add_argument("--track-size", type=int, default=512, help="KB per track")
+    parser.add_argument("--bandwidth", type=float, default=8, help="MB/s per stream")
+    parser.add_argument("--rate-limits", action="store_true")
+    parser.add_argument(
+        "--catalog", type=Path, help="serve the Web API JSON of a catalog file"
+    )
+    parser.add_argument(
+        "--save-catalog", type=Path, help="write the generated catalog to a file"
+    )
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario: {name}")
+    return args
+
+
+def create_element(catalog: Catalog, type: str, track_count: int) -> str:
+    if type == "playlist":
+        return catalog.add_playlist(track_count)
+    if type == "artist":
+        return catalog.add_artist(track_count)
+    album_id = catalog.add_album(track_count)
+    if type == "album":
+        return album_id
+    return catalog.albums[album_id]["tracks"][0]["id"]
+
+
+def pick_element(catalog: Catalog, type: str) -> str:
+    """Element of a loaded catalog: the first track, the largest album or
+    playlist, or the artist with the most releases."""
+    if type == "playlist":
+        return max(catalog.playlists, key=lambda id_: len(catalog.playlists[id_]))
+    if type == "album":
+        return max(catalog.albums, key=lambda id_: len(catalog.albums[id_]["tracks"]))
+    if type == "artist":
+        releases = Counter(
+            album["tracks"][0]["artists"][0]["id"]
+            for album in catalog.albums.values()
+            if album["tracks"]
+        )
+        return releases.most_common(1)[0][0]
+    return next(iter(catalog.tracks))
+
+
+def run_scenario(
+    name: str, profile: Profile, catalog: Catalog, loaded: bool = False
+) -> dict:
+    # Imported here, as the working directory is the temporary folder
+    from src.cover_cache import cover_cache
+    from src.library_index import LibraryIndex
+    from src.metadata_cache import MetadataCache
+    from src.metrics import metrics
+    from src.scheduler import get_scheduler
+    from src.spotify_api import SpotifyAPI
+    from src import spotify_dl
+
+    spotify_dl.OPEN_IN_EXPLORER_AFTER_DOWNLOAD = False
+    spotify_dl.LIBRESPOT_METADATA = (
+        set() if name.endswith("web-api") else LIBRESPOT_METADATA
+    )
+    type, track_count = SCENARIOS[name]
+    if loaded:
+        element_id = pick_element(catalog, type)
+    else:
+        element_id = create_element(catalog, type, track_count)
+    ls = FakeLibrespot(profile, catalog)
+    scheduler = get_scheduler(ls)
+    scheduler.ls = ls
+    cache_path = Path("cache") / f"{name}.sqlite3"
+    covers = FakeHTTPSession(profile)
+    cover_cache.folder = Path("cache") / f"covers-{name}"
+    cover_cache.session = covers
+
+    results = {}
+    for state in ["cold", "warm"]:
+        # Start from an empty library, so that every track is downloaded
+        scheduler.library.close()
+        shutil.rmtree("songs", ignore_errors=True)
+        Path("cache/library.sqlite3").unlink(missing_ok=True)
+        scheduler.library = LibraryIndex()
+        if state == "cold":
+            cache_path.unlink(missing_ok=True)
+            shutil.rmtree(cover_cache.folder, ignore_errors=True)
+        cover_cache.pictures.clear()
+
+        api = SpotifyAPI()
+        api.cache = MetadataCache(cache_path)
+        api.api = FakeSpotify(catalog, profile)
+        api.valid_app = True
+        covers.requests = 0
+        ls.calls = {}
+        metrics.reset()
+
+        start = time.perf_counter()
+        downloaded = spotify_dl.request(
+            f"https://open.spotify.com/{type}/{element_id}", ls, api
+        )
+        elapsed = time.perf_counter() - start
+        api.cache.close()
+
+        summary = metrics.summary()
+        size = sum(summary.get("spotifydl_transfer_bytes_total", {}).values())
+        results[state] = {
+            "tracks": sum(result is True for _, result in downloaded),
+            "seconds": round(elapsed, 3),
+            "tracks_per_second": round(len(downloaded) / elapsed, 2),
+            "mb_per_second": round(size / elapsed / 1e6, 2),
+            "web_api_requests": api.api.calls,
+            "librespot_requests": ls.calls,
+            "cover_requests": covers.requests,
+            "stages": {name: summary.get(name, {}) for name in REPORTED},
+        }
+    return results
+
+
+def print_results(name: str, results: dict) -> None:
+    for state, result in results.items():
+        print(
+            f"\n{name} ({state}): {result['tracks']} tracks in "
+            f"{result['seconds']:.2f}s, {result['tracks_per_second']:.1f} tracks/s, "
+            f"{result['mb_per_second']:.1f} MB/s"
+        )
+        for source in ["Web API", "Librespot"]:
+            calls = result[f"{source.lower().replace(' ', '_')}_requests"].items()
+            calls = ", ".join(f"{endpoint}={count}" for endpoint, count in calls)
+            print(f"  {source} requests: {calls or 'none'}")
+        print(f"  Cover requests: {result['cover_requests']}")
+        print(f"  {'Stage':<44} {'count':>6} {'p50':>9} {'p99':>9}")
+        for metric, series in result["stages"].items():
+            short = metric.removeprefix("spotifydl_")
+            for labels, stats in series.items():
+                if metric == "spotifydl_queue_depth":
+                    p50, p99 = f"{stats['p50']:.1f}", f"{stats['p99']:.1f}"
+                else:
+                    p50 = f"{stats['p50'] * 1000:.0f}ms"
+                    p99 = f"{stats['p99'] * 1000:.0f}ms"
+                row = f"{short} {labels}"
+                print(f"  {row:<44} {stats['count']:>6} {p50:>9} {p99:>9}")
+
+
+def main() -> None:
+    args = parse_args()
+    profile = Profile(track_size=args.track_size * 1024, bandwidth=args.bandwidth * 1e6)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    if not args.rate_limits:
+        from src.rate_limit import TokenBucket, governor
+
+        for kind in governor.buckets:
+            governor.buckets[kind] = TokenBucket(1e6, 1_000_000)
+
+    catalog = Catalog.load(args.catalog) if args.catalog else Catalog()
+    # Resolved before moving to the temporary folder
+    save_path = args.save_catalog.resolve() if args.save_catalog else None
+    all_results = {}
+    root = Path.cwd()
+    with tempfile.TemporaryDirectory() as folder:
+        # Tracks and caches use paths relative to the working directory
+        os.chdir(folder)
+        try:
+            for name in args.scenarios or SCENARIOS:
+                all_results[name] = run_scenario(
+                    name, profile, catalog, loaded=bool(args.catalog)
+                )
+                print_results(name, all_results[name])
+        finally:
+            os.chdir(root)
+
+    if save_path:
+        catalog.save(save_path)
+    if args.json:
+        args.json.write_text(json.dumps(all_results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,194 @@
+"""Memory of large jobs: peak memory of downloading playlists of growing
+size through `spotify_dl.request`, against the offline stand-ins of fakes.py
+(each job in its own process), then size of the Track descriptors.
+Audio streams are released after their transfer, so the memory used while
+downloading should not grow with the number of tracks. What is left after
+the job does: the returned results, the library index entries and the file
+names interned by pathlib, about 1.4 KB per track, plus the bounded caches
+(encoded covers).
+
+Usage: python -m benchmarks.bench_memory [--tracks N ...] [--track-size KB]
+Peak memory is read from getrusage, so jobs are only measured on Linux/macOS.
+"""
+
+import argparse
+import gc
+import json
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+from benchmarks.fakes import (
+    Catalog,
+    FakeHTTPSession,
+    FakeLibrespot,
+    FakeSpotify,
+    Profile,
+    base62_id,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--tracks", type=int, nargs="+", default=[500, 2000, 5000], help="job sizes"
+    )
+    parser.add_argument("--track-size", type=int, default=256, help="KB per track")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def descriptor_size(count: int = 100_000) -> None:
+    from src.track_dataclass import Track
+
+    data = {
+        "title": "Track title",
+        "artists": ["Artist"],
+        "album": "Album name",
+        "source_url": None,
+        "date": "2024",
+        "cover_url": "https://i.scdn.co/image/ab67616d0000b273",
+        "duration": 180,
+        "track_number": 1,
+        "disc_number": 1,
+    }
+    tracemalloc.start()
+    tracks = [Track.from_dict({**data, "id": base62_id(i)}) for i in range(count)]
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    duplicates = [Track.from_dict({**data, "id": base62_id(i)}) for i in range(count)]
+    unique = len(set(tracks + duplicates))
+    print(
+        f"Track descriptor: {size / count:.0f} bytes each "
+        f"(with its strings), {unique}/{2 * count} unique after deduplication"
+    )
+
+
+def peak_rss() -> int:
+    """Peak resident memory of the process, in bytes."""
+    import resource
+
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def run_job(track_count: int, track_size: int) -> None:
+    """Child process: download a playlist and print its memory as JSON."""
+    from src.cover_cache import cover_cache
+    from src.rate_limit import TokenBucket, governor
+    from src.scheduler import get_scheduler
+    from src.spotify_api import SpotifyAPI
+    from src import spotify_dl
+
+    logging.getLogger().setLevel(logging.ERROR)
+    for kind in governor.buckets:
+        governor.buckets[kind] = TokenBucket(1e6, 1_000_000)
+    spotify_dl.OPEN_IN_EXPLORER_AFTER_DOWNLOAD = False
+
+    # No latency: memory is the point here
+    profile = Profile(
+        web_api_latency=0,
+        audio_key_latency=0,
+        chunk_latency=0,
+        bandwidth=1e12,
+        cover_latency=0,
+        track_size=track_size,
+    )
+    catalog = Catalog()
+    playlist_id = catalog.add_playlist(track_count)
+    ls = FakeLibrespot(profile)
+    get_scheduler(ls).ls = ls
+    cover_cache.session = FakeHTTPSession(profile)
+    api = SpotifyAPI()
+    api.api = FakeSpotify(catalog, profile)
+    api.valid_app = True
+
+    before = peak_rss()
+    tracemalloc.start()
+    results = spotify_dl.request(
+        f"https://open.spotify.com/playlist/{playlist_id}", ls, api
+    )
+    gc.collect()  # Only what is still referenced is kept
+    kept, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(
+        json.dumps(
+            {
+                "downloaded": sum(result is True for _, result in results),
+                "before": before,
+                "peak": peak_rss(),
+                "python_peak": peak,
+                "python_kept": kept,
+            }
+        )
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    if args.child:
+        run_job(args.child, args.track_size * 1024)
+        return
+
+    print(
+        f"{'tracks':>8} {'downloaded':>11} {'start MB':>9} {'peak MB':>8} "
+        f"{'job MB':>7} {'Python peak MB':>15} {'Python kept MB':>15}"
+    )
+    results = []
+    root = Path.cwd()
+    path = os.pathsep.join(filter(None, [str(root), os.environ.get("PYTHONPATH")]))
+    for track_count in args.tracks:
+        with tempfile.TemporaryDirectory() as folder:
+            # Tracks and caches use paths relative to the working directory
+            output = subprocess.run(
+                [
+                    sys.executable,
+                    "-m",
+                    "benchmarks.bench_memory",
+                    "--child",
+                    str(track_count),
+                    "--track-size",
+                    str(args.track_size),
+                ],
+                cwd=folder,
+                env={**os.environ, "PYTHONPATH": path},
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{track_count:>8} {result['downloaded']:>11} "
+            f"{result['before'] / 1e6:>9.1f} {result['peak'] / 1e6:>8.1f} "
+            f"{(result['peak'] - result['before']) / 1e6:>7.1f} "
+            f"{result['python_peak'] / 1e6:>15.1f} "
+            f"{result['python_kept'] / 1e6:>15.1f}"
+        )
+        results.append((track_count, result))
+
+    # Memory used while downloading (streams, queues), and left after the job
+    (first, small), (last, large) = results[0], results[-1]
+    if last > first:
+        kept = (large["python_kept"] - small["python_kept"]) / (last - first)
+        transient = (
+            large["python_peak"]
+            - large["python_kept"]
+            - (small["python_peak"] - small["python_kept"])
+        ) / (last - first)
+        print(
+            f"Per extra track: {transient:.0f} bytes while downloading, "
+            f"{kept:.0f} bytes kept"
+        )
+
+    # Last: the peak memory of this process is inherited by the jobs
+    print()
+    descriptor_size()
+
+
+if __name__ == "__main__":
+    main()
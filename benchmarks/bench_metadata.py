@@ -0,0 +1,166 @@
+"""Latency per album of the Web API and Librespot metadata paths.
+
+Record fixtures (needs credentials.json, a .env file and network access):
+    python -m benchmarks.bench_metadata --record <album ID> [<album ID>..]
+Replay the recorded responses and latencies, offline:
+    python -m benchmarks.bench_metadata
+"""
+
+import asyncio
+import base64
+import json
+import sys
+import time
+from pathlib import Path
+
+from librespot.proto import Metadata_pb2 as Metadata
+
+from src.libre_spotify import Librespot, LibrespotPool
+from src.metadata_cache import MetadataCache
+from src.spotify_api import SpotifyAPI
+
+FIXTURES = Path(__file__).parent / "fixtures" / "metadata"
+
+
+def call_key(method: str, args: tuple, kwargs: dict) -> str:
+    return json.dumps([method, list(args), kwargs], sort_keys=True)
+
+
+class WebAPIRecorder:
+    """Wraps a spotipy client, and records every response with its latency."""
+
+    def __init__(self, client, calls: dict) -> None:
+        self.client = client
+        self.calls = calls
+
+    def __getattr__(self, method: str):
+        def call(*args, **kwargs):
+            start = time.perf_counter()
+            response = getattr(self.client, method)(*args, **kwargs)
+            self.calls[call_key(method, args, kwargs)] = {
+                "latency": time.perf_counter() - start,
+                "response": response,
+            }
+            return response
+
+        return call
+
+
+class WebAPIReplay:
+    def __init__(self, calls: dict) -> None:
+        self.calls = calls
+
+    def __getattr__(self, method: str):
+        def call(*args, **kwargs):
+            recorded = self.calls[call_key(method, args, kwargs)]
+            time.sleep(recorded["latency"])
+            return recorded["response"]
+
+        return call
+
+
+class LibrespotReplay(Librespot):
+    """Serves the recorded protobuf responses instead of a session."""
+
+    def __init__(self, calls: dict) -> None:
+        super().__init__()
+        self.calls = calls
+
+    def replay_(self, key: str, message) -> list:
+        recorded = self.calls[key]
+        time.sleep(recorded["latency"])
+        return [
+            message.FromString(base64.b64decode(response))
+            for response in recorded["responses"]
+        ]
+
+    def get_tracks_metadata(self, track_ids: list[str]) -> list[Metadata.Track]:
+        return self.replay_(f"tracks:{','.join(track_ids)}", Metadata.Track)
+
+    def get_album_metadata(self, album_id: str) -> Metadata.Album:
+        return self.replay_(f"album:{album_id}", Metadata.Album)[0]
+
+
+def uncached_api() -> SpotifyAPI:
+    api = SpotifyAPI()
+    api.cache = MetadataCache(ttls={})  # Every request hits the network
+    return api
+
+
+def record(album_ids: list[str]) -> None:
+    api = uncached_api()
+    ls = LibrespotPool(size=1)
+    asyncio.run(api.init_api())
+    asyncio.run(ls.create_session())
+    FIXTURES.mkdir(exist_ok=True, parents=True)
+
+    librespot_calls: dict = {}
+    for name in ["tracks", "album"]:
+        fetch = getattr(ls, f"get_{name}_metadata")
+
+        # Batches of tracks are recorded as a whole
+        def recorded(ids, name=name, fetch=fetch):
+            start = time.perf_counter()
+            response = fetch(ids)
+            batch = name == "tracks"
+            librespot_calls[f"{name}:{','.join(ids) if batch else ids}"] = {
+                "latency": time.perf_counter() - start,
+                "responses": [
+                    base64.b64encode(message.SerializeToString()).decode()
+                    for message in (response if batch else [response])
+                ],
+            }
+            return response
+
+        setattr(ls, f"get_{name}_metadata", recorded)
+
+    for album_id in album_ids:
+        web_api_calls: dict = {}
+        librespot_calls.clear()
+        api.api = WebAPIRecorder(api.api, web_api_calls)
+        list(api.get_tracks_stream(id_=album_id, type="album")[1])
+        list(ls.get_tracks_stream(album_id, "album")[1])
+        api.api = api.api.client
+
+        fixture = {"web_api": web_api_calls, "librespot": dict(librespot_calls)}
+        (FIXTURES / f"{album_id}.json").write_text(json.dumps(fixture))
+        print(f"Recorded {album_id}")
+
+    ls.close_session()
+
+
+def replay() -> None:
+    fixtures = sorted(FIXTURES.glob("*.json"))
+    if not fixtures:
+        print(f"No fixtures in {FIXTURES}, record some with --record.")
+        return
+
+    print(f"{'Album':<24} {'Tracks':>6} {'Web API':>10} {'Librespot':>10}")
+    for path in fixtures:
+        album_id = path.stem
+        fixture = json.loads(path.read_text())
+        api = uncached_api()
+        api.api = WebAPIReplay(fixture["web_api"])
+        ls = LibrespotReplay(fixture["librespot"])
+
+        resolvers = [
+            lambda: api.get_tracks_stream(id_=album_id, type="album"),
+            lambda: ls.get_tracks_stream(album_id, "album"),
+        ]
+        timings = []
+        for resolve in resolvers:
+            start = time.perf_counter()
+            tracks = list(resolve()[1])
+            timings.append(time.perf_counter() - start)
+
+        print(
+            f"{album_id:<24} {len(tracks):>6} "
+            f"{timings[0] * 1000:>8.0f}ms {timings[1] * 1000:>8.0f}ms"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 2 and sys.argv[1] == "--record":
+        record(sys.argv[2:])
+    else:
+        replay()
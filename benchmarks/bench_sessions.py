@@ -0,0 +1,169 @@
+"""Librespot session pool (LibrespotPool) with stub sessions: acquire and
+release throughput from many threads (utilization published as metrics
+gauges), then the health checks (sessions marked unhealthy after repeated
+failures and recreated in the background, backend API error responses not
+counted as failures).
+Fails if the pool does not behave as expected.
+
+Usage: python -m benchmarks.bench_sessions [--sessions N] [--threads N]
+    [--requests N]
+"""
+
+import argparse
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
+from types import SimpleNamespace
+
+from librespot.core import ApiClient
+
+from src.libre_spotify import LibrespotPool
+from src.metrics import metrics
+
+
+class StubSession:
+    """Stands for a Librespot session, only records its closing."""
+
+    def __init__(self, number: int) -> None:
+        self.number = number
+        self.closed = False
+
+    def close(self) -> None:
+        self.closed = True
+
+
+class StubSessionFactory:
+    def __init__(self) -> None:
+        self.sessions: list[StubSession] = []
+        self.lock = threading.Lock()
+
+    def __call__(self) -> StubSession:
+        with self.lock:
+            session = StubSession(len(self.sessions))
+            self.sessions.append(session)
+            return session
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sessions", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=2000, help="per thread")
+    return parser.parse_args()
+
+
+def check(condition: bool, message: str) -> None:
+    if not condition:
+        raise SystemExit(f"Failed: {message}")
+
+
+def create_pool(sessions: int, health_interval: float = 3600) -> LibrespotPool:
+    pool = LibrespotPool(
+        sessions, session_factory=StubSessionFactory(), health_interval=health_interval
+    )
+    asyncio.run(pool.generate_session())
+    return pool
+
+
+def bench_concurrency(sessions: int, threads: int, requests: int) -> None:
+    pool = create_pool(sessions)
+    peak = [0] * sessions
+    in_use = [0] * sessions
+    lock = threading.Lock()
+
+    def worker() -> None:
+        for _ in range(requests):
+            with pool.acquire() as session:
+                number = session.number
+                with lock:
+                    in_use[number] += 1
+                    peak[number] = max(peak[number], in_use[number])
+                time.sleep(0)  # Let the other threads acquire meanwhile
+                with lock:
+                    in_use[number] -= 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(threads) as executor:
+        for future in [executor.submit(worker) for _ in range(threads)]:
+            future.result()
+    elapsed = time.perf_counter() - start
+
+    state = pool.utilization()
+    published = metrics.summary()["spotifydl_librespot_session_requests"]
+    pool.close_session()
+    counts = [session["requests"] for session in state]
+    print(
+        f"{threads} threads, {sessions} sessions: "
+        f"{threads * requests / elapsed:,.0f} acquires/s, "
+        f"requests per session {counts}, peak in use {peak}"
+    )
+    check(sum(counts) == threads * requests, "every acquire is counted")
+    check(
+        published == {f"session={i}": count for i, count in enumerate(counts)},
+        "utilization published",
+    )
+    check(all(session["in_use"] == 0 for session in state), "every session released")
+    check(max(counts) - min(counts) <= threads, "requests balanced between sessions")
+
+
+def bench_health(sessions: int) -> None:
+    pool = create_pool(sessions, health_interval=0.05)
+    factory = pool.session_factory
+    rejected = ApiClient.StatusCodeException(SimpleNamespace(status_code=404))
+
+    # Backend API error responses don't make a session unhealthy
+    for _ in range(pool.MAX_FAILURES * 2):
+        try:
+            with pool.acquire():
+                raise rejected
+        except ApiClient.StatusCodeException:
+            pass
+    check(all(session["healthy"] for session in pool.utilization()), "404 ignored")
+
+    # Repeated failures do, until the session is recreated.
+    # The other sessions are kept busy, so that the same one fails each time
+    with ExitStack() as busy:
+        for _ in range(sessions - 1):
+            busy.enter_context(pool.acquire())
+        for _ in range(pool.MAX_FAILURES):
+            try:
+                with pool.acquire() as failing:
+                    raise RuntimeError("Failed fetching audio key")
+            except RuntimeError:
+                pass
+        state = pool.utilization()[failing.number]
+        check(not state["healthy"], "session unhealthy after repeated failures")
+        with pool.acquire() as session:
+            check(session is not failing, "unhealthy session avoided")
+
+    start = time.perf_counter()
+    while len(factory.sessions) == sessions and time.perf_counter() - start < 5:
+        time.sleep(0.01)
+    elapsed = time.perf_counter() - start
+    check(len(factory.sessions) == sessions + 1, "unhealthy session recreated")
+    state = pool.utilization()
+    check(all(session["healthy"] for session in state), "pool healthy again")
+    check(all(session["failures"] == 0 for session in state), "failures reset")
+    check(not failing.closed, "replaced session kept for its running streams")
+
+    pool.close_session()
+    check(all(session.closed for session in factory.sessions), "sessions closed")
+    print(
+        f"Unhealthy session recreated after {elapsed * 1000:.0f} ms "
+        f"(health check every {pool.health_interval * 1000:.0f} ms), "
+        "error responses ignored"
+    )
+
+
+def main() -> None:
+    args = parse_args()
+    logging.getLogger().setLevel(logging.WARNING)
+    bench_concurrency(args.sessions, args.threads, args.requests)
+    bench_health(args.sessions)
+
+
+if __name__ == "__main__":
+    main()
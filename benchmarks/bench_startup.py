@@ -0,0 +1,90 @@
+"""Time to import the entry points, and time until the Spotify API is ready,
+each measured in a fresh interpreter (no network, no Spotify account).
+
+Usage: python -m benchmarks.bench_startup [--importtime <module>]
+--importtime lists the slowest imports of a module, using python -X importtime.
+"""
+
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+ROOT = Path(__file__).parent.parent
+MODULES = ["main", "spicetify_server", "src.spotify_dl", "src.spotify_api"]
+RUNS = 5
+
+IMPORT_SCRIPT = """
+import time
+start = time.perf_counter()
+import {module}
+print(time.perf_counter() - start)
+"""
+
+# Dummy credentials: the client is built, but never used
+API_READY_SCRIPT = """
+import time
+start = time.perf_counter()
+import asyncio
+from src.spotify_api import SpotifyAPI
+api = SpotifyAPI()
+asyncio.run(api.init_api())
+print(time.perf_counter() - start)
+"""
+
+
+def run(script: str, cwd: str, *flags: str) -> subprocess.CompletedProcess:
+    env = dict(
+        os.environ,
+        PYTHONPATH=str(ROOT),
+        SPOTIPY_CLIENT_ID="0" * 32,
+        SPOTIPY_CLIENT_SECRET="0" * 32,
+    )
+    return subprocess.run(
+        [sys.executable, *flags, "-c", script],
+        cwd=cwd,
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+
+def median_time(script: str, cwd: str) -> float:
+    return statistics.median(
+        float(run(script, cwd).stdout.split()[-1]) for _ in range(RUNS)
+    )
+
+
+def importtime(module: str, cwd: str, top: int = 15) -> None:
+    # Lines: "import time: self [us] | cumulative | imported package"
+    lines = run(f"import {module}", cwd, "-X", "importtime").stderr.splitlines()
+    rows = []
+    for line in lines:
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, _, name = line.split(":", 1)[1].split("|")
+        rows.append((int(self_us), name.strip()))
+    for self_us, name in sorted(rows, reverse=True)[:top]:
+        print(f"{self_us / 1000:>8.1f}ms  {name}")
+
+
+def main() -> None:
+    # Run in an empty folder, so that caches and .env are not reused
+    with tempfile.TemporaryDirectory() as cwd:
+        if len(sys.argv) > 2 and sys.argv[1] == "--importtime":
+            importtime(sys.argv[2], cwd)
+            return
+
+        print(f"Median of {RUNS} runs")
+        for module in MODULES:
+            elapsed = median_time(IMPORT_SCRIPT.format(module=module), cwd)
+            print(f"{'import ' + module:<32} {elapsed * 1000:>8.0f}ms")
+        elapsed = median_time(API_READY_SCRIPT, cwd)
+        print(f"{'Spotify API ready':<32} {elapsed * 1000:>8.0f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+"""Playlist sync (`--sync`) against the offline stand-ins of fakes.py:
+a first sync downloading every playlist, a full re-listing through
+`spotify_dl.request` as done before sync existed, a sync of the unchanged
+playlists, then a sync after tracks were added to and removed from each one.
+With --prune, checks that the removed tracks are deleted, except one
+downloaded on its own before the first sync.
+
+Usage: python -m benchmarks.bench_sync [--playlists N] [--tracks N]
+    [--changes N] [--prune]
+"""
+
+import argparse
+import logging
+import os
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fakes import (
+    Catalog,
+    FakeHTTPSession,
+    FakeLibrespot,
+    FakeSpotify,
+    Profile,
+)
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--playlists", type=int, default=10)
+    parser.add_argument("--tracks", type=int, default=500, help="per playlist")
+    parser.add_argument(
+        "--changes", type=int, default=5, help="tracks added and removed"
+    )
+    parser.add_argument("--prune", action="store_true")
+    return parser.parse_args()
+
+
+def edit_playlists(catalog: Catalog, changes: int) -> None:
+    for playlist_id, items in catalog.playlists.items():
+        album_id = catalog.add_album(changes)
+        added = [{"track": track} for track in catalog.albums[album_id]["tracks"]]
+        catalog.playlists[playlist_id] = items[changes:] + added
+
+
+def run(args: argparse.Namespace, profile: Profile) -> None:
+    # Imported here, as the working directory is the temporary folder
+    from src.cover_cache import cover_cache
+    from src.playlist_sync import PlaylistSync
+    from src.scheduler import get_scheduler
+    from src.spotify_api import SpotifyAPI
+    from src import spotify_dl
+
+    spotify_dl.OPEN_IN_EXPLORER_AFTER_DOWNLOAD = False
+    catalog = Catalog()
+    playlist_ids = [catalog.add_playlist(args.tracks) for _ in range(args.playlists)]
+    urls = [f"https://open.spotify.com/playlist/{id_}" for id_ in playlist_ids]
+    cover_cache.session = FakeHTTPSession(profile)
+    ls = FakeLibrespot(profile)
+    get_scheduler(ls).ls = ls
+    api = SpotifyAPI()
+    api.api = FakeSpotify(catalog, profile)
+    api.valid_app = True
+    sync = PlaylistSync(ls, api, args.prune, folder=Path("songs"))
+
+    def measure(name: str, action) -> None:
+        api.api.calls = {}
+        start = time.perf_counter()
+        action()
+        elapsed = time.perf_counter() - start
+        calls = ", ".join(f"{key}={count}" for key, count in api.api.calls.items())
+        print(f"{name:<22} {elapsed:>8.2f}s  Web API: {calls or 'none'}")
+
+    # Downloaded on its own, then removed from its playlist
+    own_id = catalog.playlists[playlist_ids[0]][0]["track"]["id"]
+    spotify_dl.request(f"https://open.spotify.com/track/{own_id}", ls, api)
+
+    print(f"{args.playlists} playlists of {args.tracks} tracks")
+    measure("first sync", lambda: sync.run(urls))
+
+    def relist() -> None:
+        api.cache.clear()  # Playlist pages expire between scheduled runs
+        for url in urls:
+            spotify_dl.request(url, ls, api)
+
+    measure("re-list (request)", relist)
+    measure("unchanged sync", lambda: sync.run(urls))
+    edit_playlists(catalog, args.changes)
+    measure(f"sync after {args.changes} edits", lambda: sync.run(urls))
+
+    for id_ in playlist_ids:
+        playlist = Path("songs") / f"Playlist {id_[-4:]}.m3u8"
+        entries = playlist.read_text(encoding="utf-8").count("#EXTINF")
+        if entries != args.tracks:
+            raise SystemExit(f"{playlist}: {entries}/{args.tracks} tracks")
+    files = sum(1 for _ in Path("songs").rglob("*.ogg"))
+    print(f"{files} files in the library")
+    if args.prune:
+        if not sync.library.get(own_id):
+            raise SystemExit("A track not downloaded by the sync was pruned")
+        expected = args.playlists * args.tracks + min(args.changes, 1)
+        if files != expected:
+            raise SystemExit(f"{files}/{expected} files kept after pruning")
+    sync.close()
+
+
+def main() -> None:
+    args = parse_args()
+    profile = Profile(track_size=64 * 1024)
+    logging.getLogger().setLevel(logging.WARNING)
+
+    from src.rate_limit import TokenBucket, governor
+
+    for kind in governor.buckets:
+        governor.buckets[kind] = TokenBucket(1e6, 1_000_000)
+
+    root = Path.cwd()
+    with tempfile.TemporaryDirectory() as folder:
+        # Tracks and caches use paths relative to the working directory
+        os.chdir(folder)
+        try:
+            run(args, profile)
+        finally:
+            os.chdir(root)
+
+
+if __name__ == "__main__":
+    main()
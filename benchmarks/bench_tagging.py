@@ -0,0 +1,87 @@
+"""Transfer and tagging time per file, tagging once downloaded with mutagen
+versus writing the FLAC tags with the stream (IN_STREAM_TAGGING).
+Streams and covers are served from memory (see fakes.py).
+
+Usage: python -m benchmarks.bench_tagging [size in MB] [files]
+"""
+
+import os
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+from benchmarks.fakes import (
+    FakeChunkedStream,
+    FakeHTTPSession,
+    Profile,
+    base62_id,
+    fake_flac,
+    fake_ogg,
+)
+
+# No simulated network, only the disk and the tagging are measured
+PROFILE = Profile(chunk_latency=0, bandwidth=float("inf"), cover_latency=0)
+
+
+def bench(name: str, data: bytes, ext: str, in_stream: bool, files: int) -> None:
+    from src import track_dataclass
+    from src.tagging import tag_file
+    from src.track_dataclass import Track, TrackStream
+
+    track_dataclass.TRY_FLAC_DOWNLOAD = ext == ".flac"  # Keeps the extension
+    track_dataclass.IN_STREAM_TAGGING = in_stream
+    transfer_time = tag_time = 0.0
+    for i in range(files):
+        track = Track(
+            id=base62_id(i + 1),
+            title=f"Track {i}",
+            album="Album",
+            cover_url="https://i.scdn.co/image/cover",
+            track_number=i + 1,
+        ).set_artist("Artist")
+        stream = TrackStream(track, FakeChunkedStream(data, PROFILE), ext)
+
+        start = time.perf_counter()
+        stream.store()
+        stream.release()
+        transfer_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        if not stream.tagged:
+            tag_file(track, stream.path)
+        tag_time += time.perf_counter() - start
+
+    total = (transfer_time + tag_time) / files
+    print(
+        f"{name:<24} {transfer_time / files * 1000:>10.1f} "
+        f"{tag_time / files * 1000:>8.1f} {total * 1000:>8.1f} "
+        f"{len(data) / total / 1e6:>8.1f}"
+    )
+
+
+def main() -> None:
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 30_000_000
+    files = int(sys.argv[2]) if len(sys.argv) > 2 else 10
+    flac = fake_flac(size)
+    ogg = fake_ogg(size // 3)  # Vorbis files are about 3 times smaller
+
+    root = Path.cwd()
+    with tempfile.TemporaryDirectory() as folder:
+        # Tracks and covers use paths relative to the working directory
+        os.chdir(folder)
+        try:
+            from src.cover_cache import cover_cache
+
+            cover_cache.session = FakeHTTPSession(PROFILE)
+            print(f"Mean per file over {files} files, FLAC {size / 1e6:.0f} MB")
+            print(f"{'':<24} transfer ms   tag ms total ms     MB/s")
+            bench("FLAC, tag after", flac, ".flac", False, files)
+            bench("FLAC, tag in stream", flac, ".flac", True, files)
+            bench("OGG, tag after", ogg, ".ogg", False, files)
+        finally:
+            os.chdir(root)
+
+
+if __name__ == "__main__":
+    main()
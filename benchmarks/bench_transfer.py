@@ -0,0 +1,74 @@
+"""Compare the old 4 KiB read loop with `copy_stream`,
+on a local fake chunked stream (no network, no Librespot).
+
+Usage: python -m benchmarks.bench_transfer [size in MB]
+"""
+
+import os
+import sys
+import tempfile
+import time
+
+from src.transfer import copy_stream
+
+CHUNK_SIZE = 128 * 1024
+
+
+class FakeChunkedStream:
+    """Mimics AbsChunkedInputStream.read: serves decrypted chunks
+    from memory, a read may span several chunks."""
+
+    def __init__(self, size: int) -> None:
+        chunk = os.urandom(CHUNK_SIZE)
+        self.chunks = [chunk] * -(-size // CHUNK_SIZE)
+        self.total = size
+        self.pos = 0
+
+    def read(self, size: int = -1) -> bytes:
+        if self.pos >= self.total:
+            return b""
+        if size < 0:
+            size = self.total - self.pos
+        size = min(size, self.total - self.pos)
+
+        parts = []
+        while size:
+            index, start = divmod(self.pos, CHUNK_SIZE)
+            part = self.chunks[index][start : start + size]
+            parts.append(part)
+            self.pos += len(part)
+            size -= len(part)
+        return b"".join(parts)
+
+
+def old_copy(stream: FakeChunkedStream, file) -> int:
+    written = 0
+    while True:
+        data = stream.read(4096)
+        if not data:
+            break
+        written += file.write(data)
+    return written
+
+
+def bench(name: str, copy, size: int, runs: int = 5) -> float:
+    best = float("inf")
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "track.flac")
+        for _ in range(runs):
+            stream = FakeChunkedStream(size)
+            start = time.perf_counter()
+            with open(path, "wb") as file:
+                assert copy(stream, file) == size
+            best = min(best, time.perf_counter() - start)
+
+    print(f"{name:<12} {best * 1000:8.1f} ms  {size / best / 1e6:8.1f} MB/s")
+    return best
+
+
+if __name__ == "__main__":
+    size = int(float(sys.argv[1]) * 1e6) if len(sys.argv) > 1 else 40_000_000
+    print(f"Copying {size / 1e6:.0f} MB, best of 5 runs")
+    old = bench("4 KiB loop", old_copy, size)
+    new = bench("copy_stream", copy_stream, size)
+    print(f"Speedup: x{old / new:.1f}")
@@ -0,0 +1,499 @@
+"""Offline stand-ins for Spotify: a Librespot session serving generated
+OGG files through a chunked stream with configurable latency and bandwidth,
+a spotipy client serving album and playlist JSON from a catalog,
+and an HTTP session serving album covers."""
+
+import hashlib
+import json
+import random
+import struct
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Iterator, Optional
+
+from src.libre_spotify import Librespot
+
+BASE62 = "0123456789abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ"
+CHUNK_SIZE = 128 * 1024  # Same as librespot's ChannelManager.chunk_size
+SAMPLE_RATE = 44100
+SPOTIFY_HEADER_SIZE = 0xA7  # Skipped by Librespot when loading a stream
+# Connections to the fake CDN, shared by every stream
+CDN_EXECUTOR = ThreadPoolExecutor(max_workers=64)
+
+
+@dataclass
+class Profile:
+    """Simulated network, latencies in seconds, bandwidth in bytes per second
+    (per CDN connection)."""
+
+    web_api_latency: float = 0.08
+    metadata_latency: float = 0.08  # Librespot backend API
+    audio_key_latency: float = 0.15
+    chunk_latency: float = 0.02  # Each CDN chunk request
+    # Chunk requests failing, dropped like Librespot does (never available)
+    chunk_error_rate: float = 0.0
+    bandwidth: float = 8e6
+    cover_latency: float = 0.05
+    track_size: int = 512 * 1024
+
+
+def base62_id(n: int) -> str:
+    """22 characters Spotify ID, unique per integer."""
+    chars = []
+    while n:
+        n, digit = divmod(n, 62)
+        chars.append(BASE62[digit])
+    return "".join(reversed(chars)).rjust(22, "0")
+
+
+def base62_decode(id_: str) -> int:
+    number = 0
+    for char in id_:
+        number = number * 62 + BASE62.index(char)
+    return number
+
+
+def fake_ogg(size: int, duration: int = 180, seed: int = 0) -> bytes:
+    """Valid Ogg Vorbis headers followed by random audio packets,
+    so that the file can be tagged by mutagen."""
+    from mutagen.ogg import OggPage
+
+    rng = random.Random(seed)
+    identification = b"\x01vorbis" + struct.pack(
+        "<IBIiiiBB", 0, 2, SAMPLE_RATE, 0, 320000, 0, 0xB8, 1
+    )
+    vendor = b"SpotifyDL benchmark"
+    comment = (
+        b"\x03vorbis" + struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", 0)
+    ) + b"\x01"
+    setup = b"\x05vorbis" + rng.randbytes(3000)
+
+    pages = []
+    for packets in [[identification], [comment, setup]]:
+        page = OggPage()
+        page.serial = 1
+        page.sequence = len(pages)
+        page.first = not pages
+        page.packets = packets
+        pages.append(page)
+
+    # 15 packets of 4000 bytes (16 lacing values each) fit in a page
+    packet = rng.randbytes(4000)
+    page_count = max(1, (size - 8000) // 60_000)
+    for i in range(page_count):
+        page = OggPage()
+        page.serial = 1
+        page.sequence = len(pages)
+        page.position = duration * SAMPLE_RATE * (i + 1) // page_count
+        page.last = i == page_count - 1
+        page.packets = [packet] * 15
+        pages.append(page)
+
+    return b"".join(page.write() for page in pages)
+
+
+def fake_flac(size: int, duration: int = 180, seed: int = 0) -> bytes:
+    """FLAC header (stream info and padding) followed by random frames."""
+    rng = random.Random(seed)
+    samples = duration * SAMPLE_RATE
+    # Sample rate (20 bits), channels - 1 (3), bits per sample - 1 (5), samples (36)
+    packed = SAMPLE_RATE << 44 | (2 - 1) << 41 | (16 - 1) << 36 | samples
+    stream_info = (
+        struct.pack(">HH", 4096, 4096)
+        + bytes(6)  # Unknown frame sizes
+        + packed.to_bytes(8, "big")
+        + bytes(16)  # MD5
+    )
+    header = b"fLaC" + b"\x00" + len(stream_info).to_bytes(3, "big") + stream_info
+    header += b"\x81" + (1024).to_bytes(3, "big") + bytes(1024)  # Last: padding
+
+    frames = rng.randbytes(CHUNK_SIZE)
+    frames *= -(-(size - len(header)) // CHUNK_SIZE)
+    return header + frames[: max(0, size - len(header))]
+
+
+class FakeChunkedStream:
+    """Mimics Librespot's CDN stream (AbsChunkedInputStream): requested chunks
+    are fetched by a thread pool, each one costing a request latency and its
+    transfer time. Reads wait for their chunk and preload the next ones."""
+
+    preload_ahead = 3  # Same as AbsChunkedInputStream
+
+    def __init__(self, data: bytes, profile: Profile, start: int = 0) -> None:
+        self.data = data
+        self.profile = profile
+        self.position = start
+        count = -(-len(data) // CHUNK_SIZE)
+        self.requested = [False] * count
+        self.available = [False] * count
+        self.chunk_buffer = [b""] * count
+        self.condition = threading.Condition()
+        self.closed = False
+        self.random = random.Random(len(data))
+        self.errors = 0
+
+    def size(self) -> int:
+        return len(self.data)
+
+    def pos(self) -> int:
+        return self.position
+
+    def seek(self, pos: int) -> None:
+        self.position = pos
+
+    def chunks(self) -> int:
+        return len(self.available)
+
+    def buffer(self) -> list[bytes]:
+        return self.chunk_buffer
+
+    def requested_chunks(self) -> list[bool]:
+        return self.requested
+
+    def available_chunks(self) -> list[bool]:
+        return self.available
+
+    def request_chunk_from_stream(self, index: int) -> None:
+        CDN_EXECUTOR.submit(self.fetch_, index)
+
+    def fetch_(self, index: int) -> None:
+        chunk = self.data[index * CHUNK_SIZE : (index + 1) * CHUNK_SIZE]
+        time.sleep(self.profile.chunk_latency + len(chunk) / self.profile.bandwidth)
+        if self.closed:
+            return
+        if self.random.random() < self.profile.chunk_error_rate:
+            self.errors += 1
+            return
+        self.chunk_buffer[index] = chunk
+        with self.condition:
+            self.available[index] = True
+            self.condition.notify_all()
+
+    def wait_chunk_(self, index: int) -> None:
+        for i in range(index, min(index + self.preload_ahead + 1, self.chunks())):
+            if not self.requested[i]:
+                self.requested[i] = True
+                self.request_chunk_from_stream(i)
+        with self.condition:
+            self.condition.wait_for(lambda: self.available[index])
+
+    def close(self) -> None:
+        """Drops the buffered chunks, like Librespot."""
+        self.closed = True
+        self.chunk_buffer = [b""] * self.chunks()
+
+    def read(self, size: int = -1) -> bytes:
+        if self.position >= len(self.data):
+            return b""
+        if size < 0:
+            size = len(self.data) - self.position
+        end = min(self.position + size, len(self.data))
+        for index in range(self.position // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            self.wait_chunk_(index)
+        data = self.data[self.position : end]
+        self.position = end
+        return data
+
+
+class FakeLoadedStream:
+    def __init__(self, stream: FakeChunkedStream) -> None:
+        self.input_stream = self
+        self.stream_ = stream
+
+    def stream(self) -> FakeChunkedStream:
+        return self.stream_
+
+
+class FakeContentFeeder:
+    def __init__(self, data: bytes, profile: Profile) -> None:
+        self.data = data
+        self.profile = profile
+
+    def load(self, track_id, audio_quality_picker, preload, halt_listener):
+        time.sleep(self.profile.audio_key_latency)  # Audio key and CDN URL
+        data = bytes(SPOTIFY_HEADER_SIZE) + self.data
+        stream = FakeChunkedStream(data, self.profile, SPOTIFY_HEADER_SIZE)
+        return FakeLoadedStream(stream)
+
+
+class FakeSession:
+    def __init__(self, profile: Profile) -> None:
+        self.feeder = FakeContentFeeder(fake_ogg(profile.track_size), profile)
+
+    def content_feeder(self) -> FakeContentFeeder:
+        return self.feeder
+
+    def close(self) -> None: ...
+
+
+class FakeLibrespot(Librespot):
+    """Single fake session. With a catalog, playlist and track metadata
+    are served like the backend API (protobufs stood in by namespaces),
+    otherwise metadata always comes from the Web API stub.
+    Counts the metadata requests per kind."""
+
+    def __init__(self, profile: Profile, catalog: Optional["Catalog"] = None) -> None:
+        super().__init__()
+        self.session = FakeSession(profile)
+        self.profile = profile
+        self.catalog = catalog
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def request_(self, kind: str) -> None:
+        with self.lock:
+            self.calls[kind] = self.calls.get(kind, 0) + 1
+        time.sleep(self.profile.metadata_latency)
+
+    def get_tracks_stream(self, id_: str, type: str) -> tuple[int, Iterator]:
+        if not self.catalog:
+            return 0, iter(())
+        return super().get_tracks_stream(id_, type)
+
+    def get_playlist_track_ids(self, playlist_id: str) -> list[str]:
+        def request(session: FakeSession) -> list[str]:
+            self.request_("playlist")
+            return [item["track"]["id"] for item in self.catalog.playlists[playlist_id]]
+
+        return self.metadata_call_(request)
+
+    def get_tracks_metadata(self, track_ids: list[str]) -> list[SimpleNamespace]:
+        def request(session: FakeSession) -> list[SimpleNamespace]:
+            self.request_("tracks")
+            return [track_proto(self.catalog.tracks[id_]) for id_ in track_ids]
+
+        return self.metadata_call_(request)
+
+
+def track_proto(track: dict) -> SimpleNamespace:
+    """Metadata.Track fields read by track_from_metadata, from Web API JSON."""
+    album = track["album"]
+    return SimpleNamespace(
+        gid=base62_decode(track["id"]).to_bytes(16, "big"),
+        name=track["name"],
+        album=SimpleNamespace(
+            name=album["name"],
+            cover_group=SimpleNamespace(
+                image=[SimpleNamespace(size=2, file_id=album["id"].encode())]
+            ),
+            date=SimpleNamespace(year=2024),
+        ),
+        duration=track["duration_ms"],
+        number=track["track_number"],
+        disc_number=track["disc_number"],
+        artist=[SimpleNamespace(name=artist["name"]) for artist in track["artists"]],
+    )
+
+
+class Catalog:
+    """Web API objects (tracks, albums, playlists), generated deterministically.
+    Can be saved and loaded as JSON to replay the same catalog."""
+
+    def __init__(self) -> None:
+        self.tracks: dict[str, dict] = {}
+        self.albums: dict[str, dict] = {}
+        self.playlists: dict[str, list[dict]] = {}
+        self.next_id = 1
+
+    def new_id_(self) -> str:
+        self.next_id += 1
+        return base62_id(self.next_id)
+
+    def simple_album_(self, album_id: str, name: str, type: str = "album") -> dict:
+        return {
+            "id": album_id,
+            "name": name,
+            "album_type": type,
+            "images": [{"url": f"https://i.scdn.co/image/{album_id}"}],
+            "external_urls": {"spotify": f"https://open.spotify.com/album/{album_id}"},
+        }
+
+    def add_album(
+        self,
+        track_count: int,
+        artist: Optional[dict] = None,
+        type: str = "album",
+        isrcs: Optional[list[str]] = None,
+    ) -> str:
+        """Album of new tracks. Tracks re-released from other albums
+        are given their ISRC."""
+        album_id = self.new_id_()
+        album = self.simple_album_(album_id, f"Album {album_id[-4:]}", type)
+        artist = artist or {"id": self.new_id_(), "name": f"Artist {album_id[-4:]}"}
+        tracks = []
+        for number in range(1, track_count + 1):
+            track_id = self.new_id_()
+            track = {
+                "id": track_id,
+                "uri": f"spotify:track:{track_id}",
+                "name": f"Track {number}",
+                "duration_ms": 180_000,
+                "track_number": number,
+                "disc_number": 1,
+                "artists": [artist],
+                "album": album,
+                "external_ids": {
+                    "isrc": isrcs[number - 1] if isrcs else f"FAKE{track_id[-8:]}"
+                },
+            }
+            self.tracks[track_id] = track
+            tracks.append(track)
+        self.albums[album_id] = {**album, "tracks": tracks}
+        return album_id
+
+    def add_artist(self, release_count: int, album_size: int = 10) -> str:
+        """Artist with albums, and as many singles re-releasing
+        the first track of an album (new track ID, same ISRC)."""
+        artist_id = self.new_id_()
+        artist = {"id": artist_id, "name": f"Artist {artist_id[-4:]}"}
+        album_ids = [
+            self.add_album(album_size, artist) for _ in range(release_count // 2)
+        ]
+        for album_id in album_ids[: release_count - len(album_ids)]:
+            first_track = self.albums[album_id]["tracks"][0]
+            self.add_album(1, artist, "single", [first_track["external_ids"]["isrc"]])
+        return artist_id
+
+    def add_playlist(self, track_count: int, album_size: int = 12) -> str:
+        playlist_id = self.new_id_()
+        track_ids = []
+        while len(track_ids) < track_count:
+            album_id = self.add_album(album_size)
+            track_ids += [track["id"] for track in self.albums[album_id]["tracks"]]
+        self.playlists[playlist_id] = [
+            {"track": self.tracks[id_]} for id_ in track_ids[:track_count]
+        ]
+        return playlist_id
+
+    def save(self, path: Path) -> None:
+        path.write_text(json.dumps(self.__dict__))
+
+    @classmethod
+    def load(cls, path: Path) -> "Catalog":
+        catalog = cls()
+        catalog.__dict__.update(json.loads(path.read_text()))
+        return catalog
+
+
+def page(items: list, limit: int, offset: int) -> dict:
+    return {
+        "items": items[offset : offset + limit],
+        "limit": limit,
+        "offset": offset,
+        "total": len(items),
+    }
+
+
+class FakeSpotify:
+    """Stands in for spotipy.Spotify, serving the catalog after a latency.
+    Counts the requests per endpoint."""
+
+    def __init__(self, catalog: Catalog, profile: Profile) -> None:
+        self.catalog = catalog
+        self.profile = profile
+        self.auth_manager = None
+        self.calls: dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def request_(self, endpoint: str) -> None:
+        with self.lock:
+            self.calls[endpoint] = self.calls.get(endpoint, 0) + 1
+        time.sleep(self.profile.web_api_latency)
+
+    def album_(self, album_id: str) -> dict:
+        album = dict(self.catalog.albums[album_id])
+        album["tracks"] = page(album["tracks"], 50, 0)
+        return album
+
+    def track(self, track_id: str) -> dict:
+        self.request_("track")
+        return self.catalog.tracks[track_id]
+
+    def tracks(self, track_ids: list[str]) -> dict:
+        self.request_("tracks")
+        return {"tracks": [self.catalog.tracks.get(id_) for id_ in track_ids]}
+
+    def album(self, album_id: str) -> dict:
+        self.request_("album")
+        return self.album_(album_id)
+
+    def albums(self, album_ids: list[str]) -> dict:
+        self.request_("albums")
+        return {
+            "albums": [
+                self.album_(id_) if id_ in self.catalog.albums else None
+                for id_ in album_ids
+            ]
+        }
+
+    def album_tracks(self, album_id: str, limit: int = 50, offset: int = 0) -> dict:
+        self.request_("album_tracks")
+        return page(self.catalog.albums[album_id]["tracks"], limit, offset)
+
+    def artist_albums(
+        self,
+        artist_id: str,
+        include_groups: str = "album,single,compilation,appears_on",
+        limit: int = 20,
+        offset: int = 0,
+    ) -> dict:
+        self.request_("artist_albums")
+        releases = [
+            {key: value for key, value in album.items() if key != "tracks"}
+            for group in include_groups.split(",")
+            for album in self.catalog.albums.values()
+            if album["album_type"] == group
+            and album["tracks"]
+            and album["tracks"][0]["artists"][0]["id"] == artist_id
+        ]
+        return page(releases, limit, offset)
+
+    def playlist(self, playlist_id: str, fields: Optional[str] = None) -> dict:
+        self.request_("playlist")
+        items = self.catalog.playlists[playlist_id]
+        track_ids = "".join(item["track"]["id"] for item in items)
+        return {
+            "name": f"Playlist {playlist_id[-4:]}",
+            # Changes with the tracks, like Spotify's snapshot IDs
+            "snapshot_id": hashlib.sha1(track_ids.encode()).hexdigest(),
+        }
+
+    def playlist_tracks(
+        self, playlist_id: str, limit: int = 100, offset: int = 0
+    ) -> dict:
+        self.request_("playlist_tracks")
+        return page(self.catalog.playlists[playlist_id], limit, offset)
+
+    def search(self, q: str, limit: int = 10, offset: int = 0, type: str = "track"):
+        self.request_("search")
+        matches = [
+            track
+            for track in self.catalog.tracks.values()
+            if q.lower() in track["name"].lower()
+        ]
+        return {f"{type}s": page(matches, limit, offset)}
+
+
+class FakeResponse:
+    def __init__(self, content: bytes) -> None:
+        self.content = content
+
+    def raise_for_status(self) -> None: ...
+
+
+class FakeHTTPSession:
+    """Stands in for the requests session of the cover cache."""
+
+    def __init__(self, profile: Profile, cover_size: int = 60_000) -> None:
+        self.profile = profile
+        self.cover = random.Random(1).randbytes(cover_size)
+        self.requests = 0
+
+    def get(self, url: str, timeout: Optional[float] = None) -> FakeResponse:
+        self.requests += 1
+        time.sleep(self.profile.cover_latency)
+        return FakeResponse(self.cover)
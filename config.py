@@ -5,6 +5,116 @@ import sys
 TRACK_FOLDER = Path("./songs")
 OPEN_IN_EXPLORER_AFTER_DOWNLOAD = True
 TRY_FLAC_DOWNLOAD = False
+# Write the tags of FLAC files with the stream, instead of tagging the file
+# once downloaded (OGG files are always tagged once downloaded)
+IN_STREAM_TAGGING = True
+# Bytes read from the audio stream at once (one CDN chunk),
+# and size of the buffer they are gathered in before being written
+TRANSFER_BLOCK_SIZE = 128 * 1024
+TRANSFER_BUFFER_SIZE = 1024 * 1024
+# CDN chunks of a track fetched at the same time, written at their position
+# in the file as they arrive. 0 reads the stream in order (Librespot still
+# preloads 3 chunks ahead). Mostly useful for large FLAC files
+PARALLEL_CHUNKS = 0
+# Seconds before requesting again a chunk that was not received (Librespot
+# drops the chunks it failed to fetch), and without any new chunk before a
+# parallel transfer fails
+CHUNK_RETRY_AFTER = 5
+CHUNK_TIMEOUT = 30
+# Index of the downloaded tracks, used to skip them
+LIBRARY_INDEX_PATH = Path("./cache/library.sqlite3")
+# Download again the indexed tracks whose file is missing or incomplete
+VERIFY_LIBRARY = False
+
+# Spotify API credentials are checked by the first real request instead of
+# a test request at startup. Access tokens are cached until they expire
+VALIDATE_API_ON_STARTUP = False
+SPOTIFY_TOKEN_CACHE_FOLDER = Path("./cache/tokens")
+
+# Types whose metadata is fetched from Librespot instead of the Web API
+# (the Web API is still used for search queries and artists).
+# Tracks and albums are faster through the Web API batch endpoints. Playlists
+# take one request per 100 tracks both ways (benchmarks/bench_download.py),
+# and their Web API responses are only cached for a few minutes
+LIBRESPOT_METADATA = {"playlist"}
+# Tracks per Librespot metadata request, and requests sent at the same time
+METADATA_BATCH_SIZE = 100
+METADATA_WORKERS = 8
+# Releases downloaded for an artist URL (album, single, compilation,
+# appears_on), empty to only download the artist's top tracks
+ARTIST_INCLUDE_GROUPS = "album,single"
+
+# Librespot sessions used to fetch audio keys and streams,
+# recreated after a given age (seconds) or after repeated failures
+LIBRESPOT_SESSIONS = 2
+LIBRESPOT_SESSION_MAX_AGE = 6 * 3600
+LIBRESPOT_HEALTH_INTERVAL = 60
+
+# Requests per second and burst size, per endpoint class.
+# Rates are lowered automatically when throttled
+RATE_LIMITS = {
+    "web_api": (10.0, 20),
+    "metadata": (20.0, 40),  # Librespot backend API
+    "audio_key": (4.0, 8),
+}
+# Retries of a throttled request before giving up
+RATE_MAX_RETRIES = 8
+
+# Maximum number of tracks downloaded at the same time (shared by all requests)
+MAX_CONCURRENT_DOWNLOADS = 8
+# Worker threads of each download stage, and size of the queues between them
+PIPELINE_WORKERS = {"metadata": 1, "resolve": 4, "transfer": 4, "tag": 2}
+PIPELINE_QUEUE_SIZE = 8
+# Playlist/album pages fetched at the same time from the Web API
+PAGE_FETCH_WORKERS = 4
+
+# Batch mode: queries resolved at the same time, and progress file to resume
+BATCH_RESOLVE_WORKERS = 4
+BATCH_CHECKPOINT_PATH = Path("./cache/batch_checkpoint.jsonl")
+
+# Queue shared by worker processes (python main.py --worker), stored with
+# the tracks so that workers sharing the track folder share the queue.
+# Tracks are leased to a worker, and queued again if it stops sending
+# heartbeats for WORK_LEASE_SECONDS
+WORK_QUEUE_PATH = TRACK_FOLDER / ".queue.sqlite3"
+WORK_LEASE_SECONDS = 120
+WORK_MAX_ATTEMPTS = 3
+WORK_CLAIM_SIZE = 4
+WORK_POLL_INTERVAL = 5
+
+# Playlist sync: last snapshot and tracks of each synced playlist,
+# and folder of the .m3u8 files (track paths are written relative to it)
+SYNC_STATE_PATH = Path("./cache/sync.sqlite3")
+SYNC_PLAYLIST_FOLDER = TRACK_FOLDER
+
+# Spicetify server: jobs running at the same time, finished jobs kept in memory
+JOB_WORKERS = 2
+JOB_HISTORY = 100
+
+# Seconds to wait for other track/album lookups to send them in one request
+BATCH_RESOLVER_WINDOW = 0.05
+
+# Web API responses cache
+METADATA_CACHE_PATH = Path("./cache/metadata.sqlite3")
+METADATA_CACHE_MAX_ENTRIES = 50_000
+# Seconds before an entry expires (0 to disable caching for that kind)
+METADATA_CACHE_TTL = {
+    "track": 30 * 86400,
+    "album": 365 * 86400,  # Albums almost never change
+    "album_tracks": 365 * 86400,
+    "artist": 86400,
+    "artist_albums": 86400,
+    "playlist": 10 * 60,
+    "search": 86400,
+}
+# Local index of the downloaded and searched tracks, answering searches
+# naming the title and an artist of a single known track without the Web API
+LOCAL_SEARCH = True
+SEARCH_INDEX_PATH = Path("./cache/search.sqlite3")
+
+# Album covers cache
+COVER_CACHE_FOLDER = Path("./cache/covers")
+COVER_CACHE_MEMORY_ITEMS = 64  # Encoded covers kept in memory
 
 # Logs
 logging.basicConfig(
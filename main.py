@@ -1,32 +1,172 @@
+import argparse
 import asyncio
+import json
+import logging
+import sys
+from pathlib import Path
+from typing import Optional
 
-from src.libre_spotify import Librespot
+from config import BATCH_CHECKPOINT_PATH
+from src.libre_spotify import LibrespotPool
+from src.metrics import metrics
 from src.spotify_api import SpotifyAPI
 from src.spotify_dl import request
 
 
-async def main() -> None:
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="SpotifyDL")
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="download every URL, URI or search query of a file "
+        "(one per line, - for stdin), then exit",
+    )
+    parser.add_argument(
+        "--checkpoint",
+        type=Path,
+        default=BATCH_CHECKPOINT_PATH,
+        help="progress file used to resume an interrupted batch",
+    )
+    parser.add_argument(
+        "--enqueue",
+        metavar="FILE",
+        help="queue the tracks of every query of a file (- for stdin) "
+        "for worker processes, then exit",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="download the queued tracks, with other workers sharing the track folder",
+    )
+    parser.add_argument(
+        "--until-empty",
+        action="store_true",
+        help="stop the worker once the queue is empty",
+    )
+    parser.add_argument(
+        "--sync",
+        metavar="FILE",
+        help="download the new tracks of every playlist of a file "
+        "(- for stdin) and write their .m3u8 files, then exit",
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="with --sync, delete the tracks removed from the playlists",
+    )
+    parser.add_argument(
+        "--reindex",
+        action="store_true",
+        help="drop the missing or modified tracks from the library index "
+        "and index the files of the track folder, then exit",
+    )
+    parser.add_argument(
+        "--metrics",
+        metavar="FILE",
+        type=Path,
+        help="write the JSON metrics summary to a file instead of stdout",
+    )
+    return parser.parse_args()
+
+
+def write_metrics(path: Optional[Path]) -> None:
+    """Summary of the time spent per stage, throughput and queue depths."""
+    summary = json.dumps(metrics.summary(), indent=2)
+    if path:
+        path.write_text(summary, encoding="utf-8")
+        logging.info(f"Metrics written to {path}")
+    else:
+        print(summary)
+
+
+async def main(args: argparse.Namespace) -> None:
+    if args.reindex:
+        from src.library_index import LibraryIndex
+
+        library = LibraryIndex()
+        library.verify(checksum=True)
+        library.rebuild()
+        library.close()
+        return
+
     # Init Spotify API and Librespot
-    ls = Librespot()
+    ls = LibrespotPool()
     api = SpotifyAPI()
     ls_init_task = ls.create_session()
     spotify_api_init_task = api.init_api()
     await asyncio.gather(ls_init_task, spotify_api_init_task)
 
+    if args.enqueue:
+        from src.batch import read_queries
+        from src.work_queue import enqueue_queries
+
+        try:
+            if args.enqueue == "-":
+                enqueue_queries(read_queries(sys.stdin), ls, api)
+            else:
+                with open(args.enqueue, encoding="utf-8") as file:
+                    enqueue_queries(read_queries(file), ls, api)
+        finally:
+            ls.close_session()
+        return
+
+    if args.worker:
+        from src.work_queue import run_worker
+
+        try:
+            run_worker(ls, until_empty=args.until_empty)
+        finally:
+            ls.close_session()
+            write_metrics(args.metrics)
+        return
+
+    if args.sync:
+        from src.playlist_sync import run_sync
+
+        try:
+            if args.sync == "-":
+                run_sync(sys.stdin, ls, api, args.prune)
+            else:
+                with open(args.sync, encoding="utf-8") as file:
+                    run_sync(file, ls, api, args.prune)
+        finally:
+            ls.close_session()
+            write_metrics(args.metrics)
+        return
+
+    if args.batch:
+        from src.batch import run_batch
+
+        try:
+            if args.batch == "-":
+                run_batch(sys.stdin, ls, api, args.checkpoint)
+            else:
+                with open(args.batch, encoding="utf-8") as file:
+                    run_batch(file, ls, api, args.checkpoint)
+        finally:
+            ls.close_session()
+            write_metrics(args.metrics)
+        return
+
     while True:
         try:
             query = input("Query: ")
             if query != "":
                 request(query, ls, api)
 
+        except Exception as e:
+            logging.error(f"Failed downloading {query}: {e}")
+
         except (KeyboardInterrupt, EOFError):
             print()
             ls.close_session()
+            logging.info(f"Metadata cache: {api.cache.stats()}")
+            write_metrics(args.metrics)
             return
 
 
 if __name__ == "__main__":
     try:
-        asyncio.run(main())
+        asyncio.run(main(parse_args()))
     except (asyncio.exceptions.CancelledError, KeyboardInterrupt, EOFError, OSError):
         ...
@@ -1,11 +1,15 @@
 import asyncio
-from flask import Flask
+import json
+from flask import Flask, Response, jsonify, request
 from flask_cors import CORS
 import logging
 
-from src.libre_spotify import Librespot
+from src.jobs import JobManager
+from src.libre_spotify import LibrespotPool
+from src.metrics import metrics
 from src.spotify_api import SpotifyAPI
-from src.spotify_dl import request
+
+ELEMENT_TYPES = {"track", "album", "playlist", "artist"}
 
 app = Flask(__name__)
 CORS(
@@ -13,25 +17,74 @@ CORS(
     resources={
         r"/*": {
             "origins": ["https://xpui.app.spotify.com"],
-            "methods": ["GET"],
+            "methods": ["GET", "POST"],
             "allow_headers": ["Content-Type"],
         }
     },
 )
 
-ls = Librespot()
+ls = LibrespotPool()
 api = SpotifyAPI()
+jobs = JobManager(ls, api)
+
+
+def element_url(element_type: str, element_id: str) -> str:
+    return f"https://open.spotify.com/{element_type}/{element_id}"
+
+
+@app.route("/jobs", methods=["POST"])
+def create_jobs():
+    # Body: {"uris": ["spotify:album:..", ..]} or {"uri": "spotify:album:.."}
+    data = request.get_json(silent=True) or {}
+    uris = data.get("uris") or [data.get("uri", "")]
+    urls = []
+    for uri in uris:
+        parts = str(uri).split(":")
+        if len(parts) != 3 or parts[0] != "spotify" or parts[1] not in ELEMENT_TYPES:
+            return jsonify(error=f"Invalid URI: {uri}"), 400
+        urls.append(element_url(parts[1], parts[2]))
+
+    return jsonify(jobs=[job.to_dict() for job in jobs.submit_many(urls)]), 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    job = jobs.get(job_id)
+    if not job:
+        return jsonify(error="Job not found"), 404
+    return jsonify(job.to_dict())
+
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def job_events(job_id):
+    # Server-sent events, until the job ends
+    if not jobs.get(job_id):
+        return jsonify(error="Job not found"), 404
+
+    def stream():
+        for event in jobs.events(job_id):
+            yield f"event: {event['event']}\ndata: {json.dumps(event)}\n\n"
+
+    return Response(
+        stream(), mimetype="text/event-stream", headers={"Cache-Control": "no-cache"}
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def get_metrics():
+    # Prometheus text format
+    return Response(
+        metrics.to_prometheus(), mimetype="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 @app.route("/<element_type>/<element_id>", methods=["GET"])
 def download(element_type, element_id):
-    # element type: track, album, playlist, (artist to be added)
-    request(
-        f"https://open.spotify.com/{element_type}/{element_id}",
-        ls,
-        api,
-        ignore_warning=True,
-    )
+    # Blocking endpoint, kept for older versions of the extension
+    if element_type not in ELEMENT_TYPES:
+        return jsonify(error=f"Invalid type: {element_type}"), 400
+    job = jobs.submit(element_url(element_type, element_id))
+    jobs.wait(job.id)
     return "keqing"
 
 
@@ -4,62 +4,92 @@
     return;
   }
 
-  const downloadItem = new Spicetify.ContextMenu.Item(
-    "Download",
-    async (uris) => {
-      for (const uri of uris) {
-        try {
-          const elementId = uri.split(":")[2];
-          const elementType = uri.split(":")[1];
-          const elementUrl = `https://api.spotify.com/v1/${
-            elementType === "track" ? "tracks" : elementType + "s"
-          }/${elementId}`;
-          const elementData = await Spicetify.CosmosAsync.get(elementUrl);
-          const elementName = elementData.name;
+  const getDisplayName = async (uri) => {
+    const elementId = uri.split(":")[2];
+    const elementType = uri.split(":")[1];
+    const elementUrl = `https://api.spotify.com/v1/${
+      elementType === "track" ? "tracks" : elementType + "s"
+    }/${elementId}`;
+    const elementData = await Spicetify.CosmosAsync.get(elementUrl);
+    const elementName = elementData.name;
 
-          let displayName;
-          if (elementData.artists) {
-            displayName = `${elementData.artists[0].name} - ${elementName}`;
-          } else {
-            displayName = elementName;
-          }
+    if (elementData.artists) {
+      return `${elementData.artists[0].name} - ${elementName}`;
+    }
+    return elementName;
+  };
 
-          Spicetify.showNotification(
-            `Downloading ${displayName}..`,
-            false,
-            3000
-          );
+  // Notify when a download job ends
+  const followJob = async (uri, job) => {
+    let displayName = uri;
+    try {
+      displayName = await getDisplayName(uri);
+    } catch (error) {
+      console.error("Error during URI parsing:", error);
+    }
 
-          fetch(`http://localhost:5000/${elementType}/${elementId}`, {
-            method: "GET",
-          })
-            .then((response) => {
-              if (response.ok) {
-                Spicetify.showNotification(
-                  `Successfully downloaded ${displayName} !`,
-                  false,
-                  3000
-                );
-              } else {
-                Spicetify.showNotification(
-                  `Error ${response.status}`,
-                  true,
-                  3000
-                );
-              }
-            })
-            .catch((error) => {
-              console.error(error);
-              Spicetify.showNotification(
-                `${error}. Make sure the SpotifyDL server is running.`,
-                true,
-                3000
-              );
-            });
-        } catch (error) {
-          console.error("Error during URI parsing:", error);
+    Spicetify.showNotification(`Downloading ${displayName}..`, false, 3000);
+
+    const events = new EventSource(
+      `http://localhost:5000/jobs/${job.id}/events`
+    );
+    const notifyEnd = (status) => {
+      if (status === "done") {
+        Spicetify.showNotification(
+          `Successfully downloaded ${displayName} !`,
+          false,
+          3000
+        );
+      } else if (status === "failed") {
+        Spicetify.showNotification(
+          `Failed downloading ${displayName}`,
+          true,
+          3000
+        );
+      }
+    };
+    // Already finished when subscribing
+    events.addEventListener("state", (event) => {
+      const state = JSON.parse(event.data).job;
+      if (state.status === "done" || state.status === "failed") {
+        events.close();
+        notifyEnd(state.status);
+      }
+    });
+    events.addEventListener("end", (event) => {
+      events.close();
+      notifyEnd(JSON.parse(event.data).status);
+    });
+    events.onerror = () => events.close();
+  };
+
+  const downloadItem = new Spicetify.ContextMenu.Item(
+    "Download",
+    async (uris) => {
+      // Queue all the selected elements in a single request
+      let jobs;
+      try {
+        const response = await fetch("http://localhost:5000/jobs", {
+          method: "POST",
+          headers: { "Content-Type": "application/json" },
+          body: JSON.stringify({ uris }),
+        });
+        if (!response.ok) {
+          Spicetify.showNotification(`Error ${response.status}`, true, 3000);
+          return;
         }
+        jobs = (await response.json()).jobs;
+      } catch (error) {
+        console.error(error);
+        Spicetify.showNotification(
+          `${error}. Make sure the SpotifyDL server is running.`,
+          true,
+          3000
+        );
+        return;
       }
+
+      jobs.forEach((job, i) => followJob(uris[i], job));
     },
     // If is track, album, playlist or artist
     (uris) => {
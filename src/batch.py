@@ -0,0 +1,170 @@
+import json
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Iterable, Iterator, Optional, TextIO
+
+from config import BATCH_CHECKPOINT_PATH, BATCH_RESOLVE_WORKERS
+from src.libre_spotify import Librespot
+from src.scheduler import get_scheduler
+from src.spotify_api import SpotifyAPI
+from src.spotify_dl import resolve_query
+from src.track_dataclass import Track
+
+
+def read_queries(lines: Iterable[str]) -> list[str]:
+    """Non-empty lines (URLs, URIs or search queries), without duplicates.
+    Lines starting with # are ignored."""
+    queries: dict[str, None] = {}
+    for line in lines:
+        line = line.strip()
+        if line and not line.startswith("#"):
+            queries[uri_to_url(line)] = None
+    return list(queries)
+
+
+def uri_to_url(query: str) -> str:
+    """spotify:album:<ID> -> https://open.spotify.com/album/<ID>"""
+    parts = query.split(":")
+    if len(parts) == 3 and parts[0] == "spotify":
+        return f"https://open.spotify.com/{parts[1]}/{parts[2]}"
+    return query
+
+
+class Checkpoint:
+    """Append-only JSON lines file, recording the resolved queries
+    and the finished tracks of a batch, so that it can be resumed."""
+
+    def __init__(self, path: Path) -> None:
+        self.path = path
+        self.resolved: dict[str, list[dict]] = {}
+        self.done: set[str] = set()
+        self.lock = threading.Lock()
+
+        if path.exists():
+            with open(path, encoding="utf-8") as file:
+                for line in file:
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:  # Interrupted while writing
+                        continue
+                    if "query" in entry:
+                        self.resolved[entry["query"]] = entry["tracks"]
+                    elif "done" in entry:
+                        self.done.add(entry["done"])
+            logging.info(
+                f"Resuming batch: {len(self.resolved)} queries resolved, "
+                f"{len(self.done)} tracks done."
+            )
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.file = open(path, "a", encoding="utf-8")
+
+    def write_(self, entry: dict) -> None:
+        with self.lock:
+            self.file.write(json.dumps(entry) + "\n")
+            self.file.flush()
+
+    def add_resolved(self, query: str, tracks: list[Track]) -> None:
+        self.write_({"query": query, "tracks": [track.to_dict() for track in tracks]})
+
+    def add_done(self, track_id: str) -> None:
+        self.write_({"done": track_id})
+
+    def close(self) -> None:
+        self.file.close()
+
+    def remove(self) -> None:
+        self.close()
+        self.path.unlink(missing_ok=True)
+
+
+class BatchDownload:
+    """Download all the tracks of many queries with a single scheduler.
+    Queries are resolved concurrently, and tracks found in several
+    of them (eg. a track in two playlists) are only downloaded once."""
+
+    def __init__(
+        self,
+        ls: Librespot,
+        api: SpotifyAPI,
+        checkpoint_path: Path = BATCH_CHECKPOINT_PATH,
+        workers: int = BATCH_RESOLVE_WORKERS,
+    ) -> None:
+        self.ls = ls
+        self.api = api
+        self.checkpoint = Checkpoint(checkpoint_path)
+        self.workers = workers
+        self.unresolved = 0
+
+    def resolve_(self, query: str) -> list[Track]:
+        _, tracks = resolve_query(query, self.ls, self.api)
+        tracks = list(tracks)
+        self.checkpoint.add_resolved(query, tracks)
+        if not tracks:
+            logging.warning(f"No tracks found: {query}")
+        return tracks
+
+    def iter_tracks(self, queries: list[str]) -> Iterator[Track]:
+        """Tracks of all the queries, without duplicates nor finished tracks,
+        yielded as soon as their query is resolved."""
+        seen = set(self.checkpoint.done)
+
+        def unique(tracks: Iterable[Track]) -> Iterator[Track]:
+            for track in tracks:
+                if track.spotify_id not in seen:
+                    seen.add(track.spotify_id)
+                    yield track
+
+        for query in queries:
+            if query in self.checkpoint.resolved:
+                yield from unique(
+                    Track.from_dict(data) for data in self.checkpoint.resolved[query]
+                )
+
+        pending = [query for query in queries if query not in self.checkpoint.resolved]
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {
+                executor.submit(self.resolve_, query): query for query in pending
+            }
+            for future in as_completed(futures):
+                try:
+                    yield from unique(future.result())
+                except Exception as e:
+                    logging.error(f"Failed resolving {futures[future]}: {e}")
+                    self.unresolved += 1
+
+    def run(self, queries: list[str]) -> list[tuple[Track, Optional[bool]]]:
+        logging.info(f"Batch of {len(queries)} queries.")
+
+        def on_result(track: Track, downloaded: Optional[bool]) -> None:
+            if downloaded is not None:
+                self.checkpoint.add_done(track.spotify_id)
+
+        results = get_scheduler(self.ls).run(self.iter_tracks(queries), on_result)
+        failed = sum(downloaded is None for _, downloaded in results)
+        logging.info(
+            f"Batch finished: {len(results) - failed} tracks done, {failed} failed."
+        )
+        # Keep the checkpoint to retry the failed tracks and queries
+        if not failed and not self.unresolved:
+            self.checkpoint.remove()
+        return results
+
+    def close(self) -> None:
+        if not self.checkpoint.file.closed:
+            self.checkpoint.close()
+
+
+def run_batch(
+    source: TextIO,
+    ls: Librespot,
+    api: SpotifyAPI,
+    checkpoint_path: Path = BATCH_CHECKPOINT_PATH,
+) -> None:
+    batch = BatchDownload(ls, api, checkpoint_path)
+    try:
+        batch.run(read_queries(source))
+    finally:
+        batch.close()
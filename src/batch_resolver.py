@@ -0,0 +1,102 @@
+import logging
+import threading
+from concurrent.futures import Future
+from typing import TYPE_CHECKING
+
+from config import BATCH_RESOLVER_WINDOW
+
+if TYPE_CHECKING:  # SpotifyAPI owns the resolver
+    from src.spotify_api import SpotifyAPI
+
+# Maximum IDs per request of the Web API multi-ID endpoints
+BATCH_LIMITS = {"track": 50, "album": 20}
+
+
+class BatchResolver:
+    """Coalesces track and album lookups into multi-ID Web API requests.
+    Lookups are queued for `window` seconds (or until a request is full),
+    then sent together. Looking up an ID that is already queued or being
+    fetched returns the same future."""
+
+    def __init__(
+        self, api: "SpotifyAPI", window: float = BATCH_RESOLVER_WINDOW
+    ) -> None:
+        self.api = api
+        self.window = window
+        self.futures: dict[str, dict[str, Future]] = {t: {} for t in BATCH_LIMITS}
+        self.queued: dict[str, list[str]] = {t: [] for t in BATCH_LIMITS}
+        self.timers: dict[str, threading.Timer] = {}
+        self.lock = threading.Lock()
+
+    def get(self, type: str, id_: str) -> Future:
+        """Future resolving to the Web API object of a track or album."""
+        cached = self.api.cache.get(type, id_)
+        if cached is not None:
+            future: Future = Future()
+            future.set_result(cached)
+            return future
+
+        with self.lock:
+            if id_ in self.futures[type]:
+                return self.futures[type][id_]
+
+            future = Future()
+            self.futures[type][id_] = future
+            self.queued[type].append(id_)
+
+            if len(self.queued[type]) >= BATCH_LIMITS[type]:
+                ids = self.take_(type)
+            else:
+                ids = []
+                if type not in self.timers:
+                    timer = threading.Timer(self.window, self.flush, (type,))
+                    timer.daemon = True
+                    self.timers[type] = timer
+                    timer.start()
+
+        # Full request, no need to wait for the timer
+        if ids:
+            threading.Thread(target=self.fetch_, args=(type, ids), daemon=True).start()
+        return future
+
+    def take_(self, type: str) -> list[str]:
+        """Pop the IDs of the next request. Must be called with the lock held."""
+        limit = BATCH_LIMITS[type]
+        ids, self.queued[type] = self.queued[type][:limit], self.queued[type][limit:]
+        if not self.queued[type] and type in self.timers:
+            self.timers.pop(type).cancel()
+        return ids
+
+    def flush(self, type: str) -> None:
+        """Send every queued lookup of a type."""
+        with self.lock:
+            self.timers.pop(type, None)
+            batches = []
+            while self.queued[type]:
+                batches.append(self.take_(type))
+
+        for ids in batches:
+            self.fetch_(type, ids)
+
+    def fetch_(self, type: str, ids: list[str]) -> None:
+        logging.debug(f"Fetching {len(ids)} {type}s in one request.")
+        try:
+            if type == "track":
+                items = self.api.call_(self.api.api.tracks, ids)["tracks"]
+            else:
+                items = self.api.call_(self.api.api.albums, ids)["albums"]
+        except Exception as e:
+            for future in self.pop_futures_(type, ids):
+                future.set_exception(e)
+            return
+
+        for id_, future, item in zip(ids, self.pop_futures_(type, ids), items):
+            if item is None:
+                future.set_exception(LookupError(f"{type} not found: {id_}"))
+            else:
+                self.api.cache.set(type, id_, item)
+                future.set_result(item)
+
+    def pop_futures_(self, type: str, ids: list[str]) -> list[Future]:
+        with self.lock:
+            return [self.futures[type].pop(id_) for id_ in ids]
@@ -0,0 +1,117 @@
+import base64
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+
+from config import COVER_CACHE_FOLDER, COVER_CACHE_MEMORY_ITEMS
+
+if TYPE_CHECKING:  # Imported on first use, for a faster startup
+    import requests
+
+
+class CoverCache:
+    """Album covers cached in memory and on disk, keyed by their URL.
+    Concurrent requests for the same cover share a single download,
+    and the base64 picture block is only encoded once per cover."""
+
+    def __init__(
+        self,
+        folder: Path = COVER_CACHE_FOLDER,
+        memory_items: int = COVER_CACHE_MEMORY_ITEMS,
+    ) -> None:
+        self.folder = folder
+        self.memory_items = memory_items
+        self.pictures: OrderedDict[tuple, str] = OrderedDict()
+        self.pending: dict[tuple, Future] = {}
+        self.lock = threading.Lock()
+        self.session: Optional["requests.Session"] = None
+
+    def get_session(self) -> "requests.Session":
+        """Pooled connections, shared by every tagging thread."""
+        with self.lock:
+            if self.session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                self.session = requests.Session()
+                adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+                self.session.mount("https://", adapter)
+                self.session.mount("http://", adapter)
+            return self.session
+
+    def get_path(self, url: str) -> Path:
+        return self.folder / f"{hashlib.sha1(url.encode()).hexdigest()}.jpg"
+
+    def fetch_(self, url: str) -> bytes:
+        path = self.get_path(url)
+        if path.exists():
+            return path.read_bytes()
+
+        response = self.get_session().get(url, timeout=30)
+        response.raise_for_status()
+        cover_bytes = response.content
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        tmp_path = path.with_suffix(".part")
+        tmp_path.write_bytes(cover_bytes)
+        tmp_path.replace(path)
+        logging.debug(f"Cover cached: {url}")
+        return cover_bytes
+
+    def coalesce_(self, key: tuple, compute: Callable[[], str]) -> str:
+        """Run `compute` once for concurrent calls with the same key."""
+        with self.lock:
+            future = self.pending.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self.pending[key] = future
+
+        if not owner:
+            return future.result()
+
+        try:
+            future.set_result(compute())
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                del self.pending[key]
+        return future.result()
+
+    def encode_(self, url: str, width: int, height: int) -> str:
+        from mutagen.flac import Picture
+
+        picture = Picture()
+        picture.type = 3  # Front Cover
+        picture.width = width
+        picture.height = height
+        picture.mime = "image/jpeg"
+        picture.desc = "Cover"
+        picture.data = self.fetch_(url)
+        encoded = base64.b64encode(picture.write()).decode("ascii")
+
+        with self.lock:
+            self.pictures[(url, width, height)] = encoded
+            while len(self.pictures) > self.memory_items:
+                self.pictures.popitem(last=False)
+        return encoded
+
+    def get_picture_block(self, url: str, width: int = 640, height: int = 640) -> str:
+        """Base64 encoded `metadata_block_picture` of a front cover.
+        The cover is downloaded and encoded at most once,
+        even if requested by several tracks at the same time."""
+        key = (url, width, height)
+        with self.lock:
+            if key in self.pictures:
+                self.pictures.move_to_end(key)
+                return self.pictures[key]
+
+        return self.coalesce_(key, lambda: self.encode_(url, width, height))
+
+
+cover_cache = CoverCache()
@@ -0,0 +1,181 @@
+import logging
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Iterator, Literal, Optional
+
+from config import JOB_HISTORY, JOB_WORKERS
+from src.libre_spotify import Librespot
+from src.spotify_api import SpotifyAPI
+from src.spotify_dl import request
+from src.track_dataclass import Track
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+
+@dataclass
+class DownloadJob:
+    id: str
+    query: str
+    status: JobStatus = "queued"
+    total: Optional[int] = None
+    tracks: list[dict] = field(default_factory=list)
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in {"done", "failed"}
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "query": self.query,
+            "status": self.status,
+            "total": self.total,
+            "completed": len(self.tracks),
+            "tracks": list(self.tracks),
+            "error": self.error,
+            "created": self.created,
+        }
+
+
+class JobManager:
+    """Download jobs running in the background.
+    Submitting a query that is already queued or running
+    returns the existing job instead of downloading it twice.
+    Progress events can be followed with `events`."""
+
+    def __init__(
+        self,
+        ls: Librespot,
+        api: SpotifyAPI,
+        workers: int = JOB_WORKERS,
+        history: int = JOB_HISTORY,
+    ) -> None:
+        self.ls = ls
+        self.api = api
+        self.history = history
+        self.jobs: OrderedDict[str, DownloadJob] = OrderedDict()
+        self.active: dict[str, DownloadJob] = {}  # By query
+        self.subscribers: dict[str, list[queue.Queue]] = {}
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="SpotifyDL-job"
+        )
+
+    def submit(self, query: str) -> DownloadJob:
+        with self.lock:
+            if query in self.active:
+                return self.active[query]
+
+            job = DownloadJob(id=uuid.uuid4().hex, query=query)
+            self.jobs[job.id] = job
+            self.active[query] = job
+            self.subscribers[job.id] = []
+            self.forget_()
+
+        self.executor.submit(self.run_, job)
+        return job
+
+    def submit_many(self, queries: list[str]) -> list[DownloadJob]:
+        """Submit several queries at once. Their tracks and albums are
+        prefetched right away, so that they share multi-ID requests."""
+        for query in queries:
+            try:
+                self.api.prefetch(query)
+            except Exception as e:
+                logging.debug(f"Failed prefetching {query}: {e}")
+        return [self.submit(query) for query in queries]
+
+    def get(self, job_id: str) -> Optional[DownloadJob]:
+        return self.jobs.get(job_id)
+
+    def forget_(self) -> None:
+        """Drop the oldest finished jobs above the history size."""
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[: max(0, len(self.jobs) - self.history)]:
+            del self.jobs[job_id]
+            self.subscribers.pop(job_id, None)
+
+    def publish_(self, job: DownloadJob, event: dict) -> None:
+        with self.lock:
+            if event["event"] == "track":
+                job.tracks.append(event["track"])
+            elif event["event"] == "total":
+                job.total = event["total"]
+            elif event["event"] == "end":
+                job.status = event["status"]
+                job.error = event.get("error")
+                self.active.pop(job.query, None)
+
+            for subscriber in self.subscribers.get(job.id, []):
+                subscriber.put(event)
+
+    def run_(self, job: DownloadJob) -> None:
+        job.status = "running"
+
+        def on_result(track: Track, downloaded: Optional[bool]) -> None:
+            status = {True: "downloaded", False: "skipped", None: "failed"}
+            progress = {
+                "title": str(track),
+                "url": track.source_url,
+                "status": status[downloaded],
+            }
+            self.publish_(job, {"event": "track", "track": progress})
+
+        try:
+            request(
+                job.query,
+                self.ls,
+                self.api,
+                on_total=lambda total: self.publish_(
+                    job, {"event": "total", "total": total}
+                ),
+                on_result=on_result,
+            )
+        except Exception as e:
+            logging.error(f"Job {job.id} failed: {e}")
+            self.publish_(job, {"event": "end", "status": "failed", "error": str(e)})
+        else:
+            self.publish_(job, {"event": "end", "status": "done"})
+
+    def events(self, job_id: str) -> Iterator[dict]:
+        """Current state of a job, then its progress events until it ends."""
+        subscriber: queue.Queue = queue.Queue()
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if not job:
+                return
+            snapshot = job.to_dict()
+            if not job.finished:
+                self.subscribers[job_id].append(subscriber)
+
+        yield {"event": "state", "job": snapshot}
+        if job.finished:
+            return
+
+        try:
+            while True:
+                event = subscriber.get()
+                yield event
+                if event["event"] == "end":
+                    return
+        finally:
+            with self.lock:
+                subscribers = self.subscribers.get(job_id, [])
+                if subscriber in subscribers:
+                    subscribers.remove(subscriber)
+
+    def wait(self, job_id: str) -> Optional[DownloadJob]:
+        """Block until a job ends."""
+        for _ in self.events(job_id):
+            pass
+        return self.get(job_id)
+
+    def shutdown(self) -> None:
+        self.executor.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,155 @@
+import hashlib
+import logging
+import sqlite3
+import threading
+from dataclasses import astuple, dataclass
+from pathlib import Path
+from typing import Optional
+
+from config import LIBRARY_INDEX_PATH, TRACK_FOLDER
+from src.track_dataclass import Track
+
+AUDIO_EXTENSIONS = {".ogg", ".flac"}
+
+
+@dataclass
+class LibraryEntry:
+    track_id: str  # Spotify base62 ID
+    path: str
+    size: int
+    codec: str
+    duration: float
+    checksum: str  # SHA-1 of the tagged file
+
+
+def file_checksum(path: Path) -> str:
+    with open(path, "rb") as file:
+        return hashlib.file_digest(file, "sha1").hexdigest()
+
+
+class LibraryIndex:
+    """Persistent index of the downloaded tracks, keyed by Spotify track ID.
+    Entries are loaded in memory, so that checking if a track
+    is already downloaded does not touch the track folder."""
+
+    def __init__(
+        self, path: Path = LIBRARY_INDEX_PATH, folder: Path = TRACK_FOLDER
+    ) -> None:
+        self.folder = folder
+        self.lock = threading.Lock()
+        new_index = not path.exists()
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            "track_id TEXT PRIMARY KEY, path TEXT, size INTEGER, "
+            "codec TEXT, duration REAL, checksum TEXT)"
+        )
+        self.db.commit()
+        self.entries: dict[str, LibraryEntry] = {
+            row[0]: LibraryEntry(*row)
+            for row in self.db.execute("SELECT * FROM tracks")
+        }
+
+        if new_index and folder.exists():
+            self.rebuild()
+
+    def __contains__(self, track_id: str) -> bool:
+        return track_id in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, track_id: str) -> Optional[LibraryEntry]:
+        return self.entries.get(track_id)
+
+    def put_(self, entry: LibraryEntry) -> None:
+        with self.lock:
+            self.entries[entry.track_id] = entry
+            self.db.execute(
+                "INSERT OR REPLACE INTO tracks VALUES (?, ?, ?, ?, ?, ?)",
+                astuple(entry),
+            )
+            self.db.commit()
+
+    def add(self, track: Track, path: Optional[Path] = None) -> LibraryEntry:
+        """Index a downloaded (and tagged) track."""
+        path = path or track.get_path()
+        duration = track.duration if isinstance(track.duration, (int, float)) else 0
+        entry = LibraryEntry(
+            track_id=track.spotify_id,
+            path=str(path),
+            size=path.stat().st_size,
+            codec=path.suffix.lstrip("."),
+            duration=duration,
+            checksum=file_checksum(path),
+        )
+        self.put_(entry)
+        return entry
+
+    def remove(self, track_id: str) -> None:
+        with self.lock:
+            self.entries.pop(track_id, None)
+            self.db.execute("DELETE FROM tracks WHERE track_id = ?", (track_id,))
+            self.db.commit()
+
+    def is_complete(self, entry: LibraryEntry, checksum: bool = False) -> bool:
+        """Check that the file of an entry is still there and has not been truncated."""
+        path = Path(entry.path)
+        try:
+            if path.stat().st_size != entry.size:
+                return False
+        except OSError:
+            return False
+        return not checksum or file_checksum(path) == entry.checksum
+
+    def verify(self, checksum: bool = False) -> list[str]:
+        """Remove the entries whose file is missing or incomplete,
+        so that they are downloaded again. Returns their track IDs."""
+        removed = [
+            track_id
+            for track_id, entry in list(self.entries.items())
+            if not self.is_complete(entry, checksum)
+        ]
+        for track_id in removed:
+            self.remove(track_id)
+        logging.info(f"Library verified, {len(removed)} tracks to download again.")
+        return removed
+
+    def rebuild(self) -> int:
+        """Index every tagged track of the track folder.
+        Files without a Spotify ID tag are ignored."""
+        import mutagen
+
+        logging.info(f"Indexing {self.folder}..")
+        count = 0
+        for path in self.folder.rglob("*"):
+            if path.suffix not in AUDIO_EXTENSIONS:
+                continue
+            try:
+                audio = mutagen.File(path)
+            except mutagen.MutagenError as e:
+                logging.debug(f"Failed reading {path}: {e}")
+                continue
+            if not audio or not audio.tags or "spotify_id" not in audio.tags:
+                continue
+
+            self.put_(
+                LibraryEntry(
+                    track_id=audio.tags["spotify_id"][0],
+                    path=str(path),
+                    size=path.stat().st_size,
+                    codec=path.suffix.lstrip("."),
+                    duration=round(audio.info.length),
+                    checksum=file_checksum(path),
+                )
+            )
+            count += 1
+
+        logging.info(f"{count} tracks indexed.")
+        return count
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
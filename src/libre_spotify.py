@@ -1,12 +1,39 @@
 import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Optional
+from typing import Callable, Iterator, Optional, TypeVar
 import logging
 
 from pathlib import Path
 
-from librespot.core import Session
-from librespot.zeroconf import ZeroconfServer
+from librespot.core import ApiClient, Session
+from librespot.metadata import AlbumId, PlaylistId, TrackId
+from librespot.proto import Metadata_pb2 as Metadata
+from librespot.proto.ExtendedMetadata_pb2 import (
+    BatchedEntityRequest,
+    BatchedExtensionResponse,
+    EntityRequest,
+    ExtensionQuery,
+)
+from librespot.proto.ExtensionKind_pb2 import ExtensionKind
+from requests.structures import CaseInsensitiveDict
+
+from config import (
+    LIBRESPOT_HEALTH_INTERVAL,
+    LIBRESPOT_SESSION_MAX_AGE,
+    LIBRESPOT_SESSIONS,
+    METADATA_BATCH_SIZE,
+    METADATA_WORKERS,
+)
+from src.metrics import metrics
+from src.rate_limit import governor
+from src.track_dataclass import Track
+
+T = TypeVar("T")
 
 
 class Librespot:
@@ -19,6 +46,9 @@ class Librespot:
         logging.info("Initializing Librespot..")
         path: Path = Path("./credentials.json")
         if not path.exists():
+            # Only needed for the first login
+            from librespot.zeroconf import ZeroconfServer
+
             session = await asyncio.to_thread(ZeroconfServer.Builder().create)
             await asyncio.sleep(3)
             logging.warning(
@@ -42,6 +72,11 @@ class Librespot:
         self.updated = datetime.now()
         logging.info("Librespot session created !")
 
+    @contextmanager
+    def acquire(self) -> Iterator[Session]:
+        """Session to use for a request."""
+        yield self.session
+
     def close_session(self) -> None:
         if self.session:
             self.session.close()
@@ -50,3 +85,306 @@ class Librespot:
 
     # The following methods get metadata purely from Spotify's backend API
     # No search endpoint but faster than the web API
+    def metadata_call_(self, func: Callable[[Session], T]) -> T:
+        def call() -> T:
+            with self.acquire() as session:
+                return func(session)
+
+        with metrics.timer("spotifydl_stage_seconds", stage="librespot_metadata"):
+            return governor.call("metadata", call, metadata_retry_after)
+
+    def get_track_metadata(self, track_id: str) -> Metadata.Track:
+        return self.metadata_call_(
+            lambda session: session.api().get_metadata_4_track(
+                TrackId.from_base62(track_id)
+            )
+        )
+
+    def get_tracks_metadata(self, track_ids: list[str]) -> list[Metadata.Track]:
+        """Metadata of several tracks in a single extended metadata request
+        (the endpoint behind get_metadata_4_track), in order.
+        Tracks missing from the response are requested on their own,
+        and left out if not found either."""
+        uris = [f"spotify:track:{track_id}" for track_id in track_ids]
+        query = [ExtensionQuery(extension_kind=ExtensionKind.TRACK_V4)]
+        body = BatchedEntityRequest(
+            entity_request=[EntityRequest(entity_uri=uri, query=query) for uri in uris]
+        ).SerializeToString()
+
+        def request(session: Session) -> bytes:
+            response = session.api().send(
+                "POST",
+                "/extended-metadata/v0/extended-metadata",
+                CaseInsensitiveDict({"content-type": "application/x-protobuf"}),
+                body,
+            )
+            ApiClient.StatusCodeException.check_status(response)
+            return response.content
+
+        batch = BatchedExtensionResponse()
+        batch.ParseFromString(self.metadata_call_(request))
+        found: dict[str, Metadata.Track] = {}
+        for array in batch.extended_metadata:
+            for data in array.extension_data:
+                if data.header.status_code == 200:
+                    track = Metadata.Track()
+                    track.ParseFromString(data.extension_data.value)
+                    found[data.entity_uri] = track
+
+        tracks = []
+        for uri, track_id in zip(uris, track_ids):
+            track = found.get(uri)
+            if track is None:
+                try:
+                    track = self.get_track_metadata(track_id)
+                except ApiClient.StatusCodeException as e:
+                    logging.warning(f"No metadata for track {track_id} ({e}).")
+                    continue
+            tracks.append(track)
+        return tracks
+
+    def iter_tracks_metadata(self, track_ids: list[str]) -> Iterator[Metadata.Track]:
+        """Tracks fetched by batches of METADATA_BATCH_SIZE, several batches
+        at the same time, and yielded in order."""
+        batches = [
+            track_ids[i : i + METADATA_BATCH_SIZE]
+            for i in range(0, len(track_ids), METADATA_BATCH_SIZE)
+        ]
+        with ThreadPoolExecutor(max_workers=METADATA_WORKERS) as executor:
+            for tracks in executor.map(self.get_tracks_metadata, batches):
+                yield from tracks
+
+    def get_album_metadata(self, album_id: str) -> Metadata.Album:
+        return self.metadata_call_(
+            lambda session: session.api().get_metadata_4_album(
+                AlbumId.from_base62(album_id)
+            )
+        )
+
+    def get_playlist_track_ids(self, playlist_id: str) -> list[str]:
+        playlist = self.metadata_call_(
+            lambda session: session.api().get_playlist(PlaylistId(playlist_id))
+        )
+        # Skip local files and episodes
+        return [
+            item.uri.split(":")[-1]
+            for item in playlist.contents.items
+            if item.uri.startswith("spotify:track:")
+        ]
+
+    def get_tracks_stream(self, id_: str, type: str) -> tuple[int, Iterator[Track]]:
+        """Same as SpotifyAPI.get_tracks_stream for tracks, albums and playlists."""
+        if type == "track":
+            return 1, iter([track_from_metadata(self.get_track_metadata(id_))])
+
+        elif type == "album":
+            album = self.get_album_metadata(id_)
+            track_ids = [
+                TrackId.from_hex(track.gid.hex()).to_spotify_uri().split(":")[-1]
+                for disc in album.disc
+                for track in disc.track
+            ]
+            tracks = (
+                track_from_metadata(track, album)
+                for track in self.iter_tracks_metadata(track_ids)
+            )
+            return len(track_ids), tracks
+
+        elif type == "playlist":
+            track_ids = self.get_playlist_track_ids(id_)
+            tracks = (
+                track_from_metadata(track)
+                for track in self.iter_tracks_metadata(track_ids)
+            )
+            return len(track_ids), tracks
+
+        return 0, iter(())
+
+
+def get_cover_url(album: Metadata.Album) -> str:
+    """URL of the largest cover of an album, or an empty string."""
+    images = sorted(album.cover_group.image, key=lambda image: image.size)
+    if not images:
+        return ""
+    return f"https://i.scdn.co/image/{images[-1].file_id.hex()}"
+
+
+def track_from_metadata(
+    track_proto: Metadata.Track, album: Optional[Metadata.Album] = None
+) -> Track:
+    album = album or track_proto.album
+    base62 = TrackId.from_hex(track_proto.gid.hex()).to_spotify_uri().split(":")[-1]
+    return Track(
+        id=base62,
+        title=track_proto.name,
+        album=album.name or "?",
+        cover_url=get_cover_url(album),
+        date=str(album.date.year) if album.date.year else "",
+        duration=round(track_proto.duration / 1000),
+        track_number=track_proto.number,
+        disc_number=track_proto.disc_number,
+        source_url=f"https://open.spotify.com/track/{base62}",
+    ).set_artists([artist.name for artist in track_proto.artist])
+
+
+def metadata_retry_after(e: Exception) -> Optional[float]:
+    """Retry metadata requests rejected with a 429 or 5xx status code."""
+    code = getattr(e, "code", None)
+    if isinstance(code, int) and (code == 429 or code >= 500):
+        return 0.0
+    return None
+
+
+def create_stored_session() -> Session:
+    return Session.Builder().stored_file().create()
+
+
+@dataclass(eq=False)
+class PooledSession:
+    session: Session
+    updated: datetime = field(default_factory=datetime.now)
+    in_use: int = 0
+    requests: int = 0
+    failures: int = 0  # Consecutive
+    healthy: bool = True
+
+
+class LibrespotPool(Librespot):
+    """Several sessions created from the stored credentials.
+    Requests go to the least busy healthy session, and sessions that failed
+    too often or are older than `max_age` seconds are recreated in the background."""
+
+    MAX_FAILURES = 3
+    RETIRE_DELAY = 600  # Seconds before closing a replaced session
+
+    def __init__(
+        self,
+        size: int = LIBRESPOT_SESSIONS,
+        session_factory: Callable[[], Session] = create_stored_session,
+        max_age: float = LIBRESPOT_SESSION_MAX_AGE,
+        health_interval: float = LIBRESPOT_HEALTH_INTERVAL,
+    ) -> None:
+        super().__init__()
+        self.size = max(1, size)
+        self.session_factory = session_factory
+        self.max_age = max_age
+        self.health_interval = health_interval
+        self.pool: list[PooledSession] = []
+        self.retired: list[tuple[float, Session]] = []
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+
+    async def generate_session(self) -> None:
+        if self.pool:
+            return
+        sessions = await asyncio.gather(
+            *(asyncio.to_thread(self.session_factory) for _ in range(self.size))
+        )
+        self.pool = [PooledSession(session) for session in sessions]
+        self.session = self.pool[0].session
+        self.updated = datetime.now()
+        threading.Thread(
+            target=self.health_loop_, name="SpotifyDL-sessions", daemon=True
+        ).start()
+        metrics.add_collector(self.publish_utilization_)
+        logging.info(f"Librespot session pool created ({self.size} sessions) !")
+
+    @contextmanager
+    def acquire(self) -> Iterator[Session]:
+        """Least busy healthy session. Runtime and connection errors raised
+        while it is used (usually audio key timeouts) count as failures,
+        unlike error responses of the backend API (404, 429..)."""
+        with self.lock:
+            candidates = [pooled for pooled in self.pool if pooled.healthy]
+            pooled = min(candidates or self.pool, key=lambda p: (p.in_use, p.requests))
+            pooled.in_use += 1
+            pooled.requests += 1
+
+        try:
+            yield pooled.session
+        except ApiClient.StatusCodeException:
+            pooled.failures = 0  # The session works, the request was rejected
+            raise
+        except (RuntimeError, ConnectionError, OSError):
+            with self.lock:
+                pooled.failures += 1
+                if pooled.failures >= self.MAX_FAILURES:
+                    pooled.healthy = False
+            raise
+        else:
+            pooled.failures = 0
+        finally:
+            with self.lock:
+                pooled.in_use -= 1
+
+    def recreate_(self, pooled: PooledSession) -> None:
+        try:
+            session = self.session_factory()
+        except Exception as e:
+            logging.error(f"Failed recreating Librespot session: {e}")
+            return
+
+        with self.lock:
+            old_session = pooled.session
+            pooled.session = session
+            pooled.updated = datetime.now()
+            pooled.failures = 0
+            pooled.healthy = True
+            if self.session is old_session:
+                self.session = session
+            # Streams loaded from the old session may still be downloading
+            self.retired.append((time.monotonic(), old_session))
+        self.updated = datetime.now()
+        logging.info("Librespot session recreated.")
+
+    def health_loop_(self) -> None:
+        while not self.closed.wait(self.health_interval):
+            with self.lock:
+                expired = [
+                    session
+                    for retired_at, session in self.retired
+                    if time.monotonic() - retired_at > self.RETIRE_DELAY
+                ]
+                self.retired = [r for r in self.retired if r[1] not in expired]
+            for session in expired:
+                session.close()
+
+            now = datetime.now()
+            for pooled in list(self.pool):
+                age = (now - pooled.updated).total_seconds()
+                if not pooled.healthy or age > self.max_age:
+                    self.recreate_(pooled)
+
+    def utilization(self) -> list[dict]:
+        """State of each session of the pool."""
+        now = datetime.now()
+        with self.lock:
+            return [
+                {
+                    "in_use": pooled.in_use,
+                    "requests": pooled.requests,
+                    "failures": pooled.failures,
+                    "healthy": pooled.healthy,
+                    "age": round((now - pooled.updated).total_seconds()),
+                }
+                for pooled in self.pool
+            ]
+
+    def publish_utilization_(self) -> None:
+        """Utilization of each session as gauges, labeled by its position."""
+        for number, state in enumerate(self.utilization()):
+            for key in ("in_use", "requests", "failures", "healthy"):
+                name = f"spotifydl_librespot_session_{key}"
+                metrics.set(name, int(state[key]), session=str(number))
+
+    def close_session(self) -> None:
+        metrics.remove_collector(self.publish_utilization_)
+        self.closed.set()
+        with self.lock:
+            pool, self.pool = self.pool, []
+            retired, self.retired = self.retired, []
+        for session in [pooled.session for pooled in pool] + [r[1] for r in retired]:
+            session.close()
+        if pool:
+            self.session = None
+            logging.info("Librespot sessions closed.")
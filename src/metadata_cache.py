@@ -0,0 +1,135 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from pathlib import Path
+from typing import Any, Callable, Optional
+
+from config import METADATA_CACHE_MAX_ENTRIES, METADATA_CACHE_PATH, METADATA_CACHE_TTL
+
+# Access times kept in memory before being written with the next insert
+ACCESS_FLUSH_SIZE = 1000
+
+
+def normalize_query(query: str) -> str:
+    """Cache key of a free-text search."""
+    return " ".join(query.lower().split())
+
+
+class MetadataCache:
+    """Persistent cache of Web API responses.
+    Entries are zlib-compressed JSON stored in SQLite, expire after a TTL
+    depending on their kind (track, album, playlist, search..),
+    and the least recently used ones are evicted above `max_entries`.
+    Reads don't write: access times are written in batches, with the inserts."""
+
+    def __init__(
+        self,
+        path: Path = METADATA_CACHE_PATH,
+        ttls: Optional[dict[str, int]] = None,
+        max_entries: int = METADATA_CACHE_MAX_ENTRIES,
+    ) -> None:
+        self.ttls = ttls if ttls is not None else METADATA_CACHE_TTL
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.accessed: dict[tuple[str, str], float] = {}  # Not written yet
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "kind TEXT, key TEXT, value BLOB, expires REAL, accessed REAL, "
+            "PRIMARY KEY (kind, key))"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS entries_accessed ON entries (accessed)"
+        )
+        self.db.commit()
+        self.size: int = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+
+    def get(self, kind: str, key: str) -> Optional[Any]:
+        now = time.time()
+        with self.lock:
+            row = self.db.execute(
+                "SELECT value, expires FROM entries WHERE kind = ? AND key = ?",
+                (kind, key),
+            ).fetchone()
+            if not row or row[1] < now:
+                self.misses += 1
+                return None
+            self.accessed[kind, key] = now
+            self.hits += 1
+        return json.loads(zlib.decompress(row[0]))
+
+    def set(self, kind: str, key: str, value: Any) -> None:
+        ttl = self.ttls.get(kind, 0)
+        if ttl <= 0:
+            return
+        now = time.time()
+        blob = zlib.compress(json.dumps(value, separators=(",", ":")).encode())
+        with self.lock:
+            exists = self.db.execute(
+                "SELECT 1 FROM entries WHERE kind = ? AND key = ?", (kind, key)
+            ).fetchone()
+            self.db.execute(
+                "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?)",
+                (kind, key, blob, now + ttl, now),
+            )
+            if not exists:
+                self.size += 1
+            self.accessed.pop((kind, key), None)
+            if self.size > self.max_entries:
+                self.evict_()
+            elif len(self.accessed) >= ACCESS_FLUSH_SIZE:
+                self.flush_accessed_()
+            self.db.commit()
+
+    def flush_accessed_(self) -> None:
+        """Write the access times of the entries read since the last flush."""
+        self.db.executemany(
+            "UPDATE entries SET accessed = ? WHERE kind = ? AND key = ?",
+            [(accessed, kind, key) for (kind, key), accessed in self.accessed.items()],
+        )
+        self.accessed.clear()
+
+    def evict_(self) -> None:
+        """Remove expired entries, then the least recently used ones.
+        Leaves some room so that the next inserts don't evict again."""
+        self.flush_accessed_()
+        self.db.execute("DELETE FROM entries WHERE expires < ?", (time.time(),))
+        self.db.execute(
+            "DELETE FROM entries WHERE rowid IN ("
+            "SELECT rowid FROM entries ORDER BY accessed LIMIT "
+            "MAX(0, (SELECT COUNT(*) FROM entries) - ?))",
+            (int(self.max_entries * 0.9),),
+        )
+        self.size = self.db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+        logging.debug(f"Metadata cache evicted down to {self.size} entries.")
+
+    def get_or_fetch(self, kind: str, key: str, fetch: Callable[[], Any]) -> Any:
+        value = self.get(kind, key)
+        if value is None:
+            value = fetch()
+            self.set(kind, key, value)
+        return value
+
+    def stats(self) -> dict[str, int]:
+        return {"hits": self.hits, "misses": self.misses, "entries": self.size}
+
+    def clear(self) -> None:
+        with self.lock:
+            self.db.execute("DELETE FROM entries")
+            self.db.commit()
+            self.accessed.clear()
+            self.size = 0
+
+    def close(self) -> None:
+        with self.lock:
+            if self.accessed:
+                self.flush_accessed_()
+                self.db.commit()
+            self.db.close()
@@ -0,0 +1,239 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+SECONDS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.075,
+    0.1,
+    0.15,
+    0.2,
+    0.3,
+    0.5,
+    0.75,
+    1,
+    1.5,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+DEPTH = (0, 1, 2, 4, 8, 16, 32, 64)
+BYTES_PER_SECOND = tuple(2**i for i in range(16, 28))  # 64 KiB/s to 128 MiB/s
+
+# Name: (type, help, histogram buckets)
+METRICS: dict[str, tuple[str, str, tuple]] = {
+    "spotifydl_web_api_seconds": (
+        "histogram",
+        "Web API requests per endpoint, including rate limit waits",
+        SECONDS,
+    ),
+    "spotifydl_stage_seconds": (
+        "histogram",
+        "Time spent per step of the download path",
+        SECONDS,
+    ),
+    "spotifydl_pipeline_seconds": (
+        "histogram",
+        "Time spent by a track in each pipeline stage",
+        SECONDS,
+    ),
+    "spotifydl_queue_depth": (
+        "histogram",
+        "Jobs already queued when a job enters a pipeline stage",
+        DEPTH,
+    ),
+    "spotifydl_transfer_bytes_per_second": (
+        "histogram",
+        "Throughput of each track transfer",
+        BYTES_PER_SECOND,
+    ),
+    "spotifydl_transfer_bytes_total": ("counter", "Bytes downloaded", ()),
+    "spotifydl_tracks_total": ("counter", "Tracks handled, by result", ()),
+    "spotifydl_searches_total": (
+        "counter",
+        "Free-text searches, by source (local index or Web API)",
+        (),
+    ),
+    "spotifydl_librespot_session_in_use": (
+        "gauge",
+        "Requests running on each Librespot session",
+        (),
+    ),
+    "spotifydl_librespot_session_requests": (
+        "gauge",
+        "Requests sent through each Librespot session",
+        (),
+    ),
+    "spotifydl_librespot_session_failures": (
+        "gauge",
+        "Consecutive failures of each Librespot session",
+        (),
+    ),
+    "spotifydl_librespot_session_healthy": (
+        "gauge",
+        "1 if the Librespot session is used, 0 while waiting to be recreated",
+        (),
+    ),
+}
+
+Labels = tuple[tuple[str, str], ...]
+
+
+class Histogram:
+    """Counts of observations per bucket, Prometheus style."""
+
+    def __init__(self, buckets: tuple) -> None:
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Estimate, interpolated within the bucket the quantile falls in."""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if seen + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.0
+                if i == len(self.buckets):  # +Inf bucket
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """Histograms, counters and gauges shared by every thread,
+    exported in the Prometheus text format or as a JSON summary.
+    Gauges are set by collectors, called before each export."""
+
+    def __init__(self) -> None:
+        self.histograms: dict[tuple[str, Labels], Histogram] = {}
+        self.counters: dict[tuple[str, Labels], float] = {}
+        self.gauges: dict[tuple[str, Labels], float] = {}
+        self.collectors: list[Callable[[], None]] = []
+        self.lock = threading.Lock()
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(METRICS[name][2])
+            histogram.observe(value)
+
+    def inc(self, name: str, value: float = 1, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name: str, value: float, **labels: str) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = value
+
+    def add_collector(self, collector: Callable[[], None]) -> None:
+        self.collectors.append(collector)
+
+    def remove_collector(self, collector: Callable[[], None]) -> None:
+        if collector in self.collectors:
+            self.collectors.remove(collector)
+
+    def collect_(self) -> None:
+        for collector in list(self.collectors):
+            collector()
+
+    @contextmanager
+    def timer(self, name: str, **labels: str) -> Iterator[None]:
+        """Observe the duration of the block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def to_prometheus(self) -> str:
+        self.collect_()
+        lines = []
+        with self.lock:
+            series = {**self.histograms, **self.counters, **self.gauges}
+            for name, (type_, help_, _) in METRICS.items():
+                keys = sorted(key for key in series if key[0] == name)
+                if not keys:
+                    continue
+                lines.append(f"# HELP {name} {help_}")
+                lines.append(f"# TYPE {name} {type_}")
+                for key in keys:
+                    labels = key[1]
+                    if type_ != "histogram":
+                        lines.append(f"{name}{format_labels(labels)} {series[key]}")
+                        continue
+
+                    histogram = series[key]
+                    bounds = [f"{bound:g}" for bound in histogram.buckets] + ["+Inf"]
+                    cumulative = 0
+                    for bound, count in zip(bounds, histogram.counts):
+                        cumulative += count
+                        bucket = format_labels(labels + (("le", bound),))
+                        lines.append(f"{name}_bucket{bucket} {cumulative}")
+                    lines.append(f"{name}_sum{format_labels(labels)} {histogram.sum}")
+                    lines.append(
+                        f"{name}_count{format_labels(labels)} {histogram.count}"
+                    )
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> dict:
+        """Count, total, mean and estimated percentiles of each histogram,
+        and the value of each counter and gauge."""
+        self.collect_()
+        summary: dict[str, dict] = {}
+        with self.lock:
+            for (name, labels), histogram in sorted(self.histograms.items()):
+                summary.setdefault(name, {})[format_key(labels)] = {
+                    "count": histogram.count,
+                    "sum": round(histogram.sum, 3),
+                    "mean": round(histogram.sum / histogram.count, 3),
+                    "p50": round(histogram.quantile(0.5), 3),
+                    "p99": round(histogram.quantile(0.99), 3),
+                }
+            for (name, labels), value in sorted(
+                {**self.counters, **self.gauges}.items()
+            ):
+                summary.setdefault(name, {})[format_key(labels)] = value
+        return summary
+
+    def reset(self) -> None:
+        with self.lock:
+            self.histograms.clear()
+            self.counters.clear()
+            self.gauges.clear()
+
+
+def format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+def format_key(labels: Labels) -> str:
+    return ",".join(f"{key}={value}" for key, value in labels) or "all"
+
+
+metrics = Metrics()
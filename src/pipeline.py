@@ -0,0 +1,119 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+
+from src.metrics import metrics
+from src.track_dataclass import Track, TrackStream
+
+
+@dataclass(eq=False)
+class Job:
+    track: Track
+    future: Future = field(default_factory=Future)
+    stream: Optional[TrackStream] = None  # From the resolve stage to the tag stage
+    downloaded: bool = False
+
+
+class Stage:
+    """Worker threads pulling jobs from a bounded queue.
+    The handler returns True to forward the job to the next stage,
+    False to resolve its future right away.
+    `put` blocks while the queue is full, which slows down the previous stage."""
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Job], bool],
+        workers: int = 1,
+        queue_size: int = 8,
+    ) -> None:
+        self.name = name
+        self.handler = handler
+        self.queue: queue.Queue[Optional[Job]] = queue.Queue(maxsize=queue_size)
+        self.next: Optional[Stage] = None
+        self.on_done: Optional[Callable[[Job], None]] = None
+        self.threads = [
+            threading.Thread(
+                target=self._work, name=f"SpotifyDL-{name}-{i}", daemon=True
+            )
+            for i in range(workers)
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, job: Job) -> None:
+        metrics.observe("spotifydl_queue_depth", self.depth(), stage=self.name)
+        self.queue.put(job)
+
+    def depth(self) -> int:
+        return self.queue.qsize()
+
+    def close(self) -> None:
+        """Stop the workers once the queued jobs are handled."""
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _finish(self, job: Job, exception: Optional[BaseException] = None) -> None:
+        if self.on_done:
+            self.on_done(job)
+        if exception:
+            job.future.set_exception(exception)
+        else:
+            job.future.set_result(job.downloaded)
+
+    def _work(self) -> None:
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            start = time.perf_counter()
+            try:
+                forward = self.handler(job)
+            except Exception as e:
+                logging.debug(f'{self.name} stage failed for "{job.track}": {e}')
+                self._finish(job, e)
+                continue
+            finally:
+                metrics.observe(
+                    "spotifydl_pipeline_seconds",
+                    time.perf_counter() - start,
+                    stage=self.name,
+                )
+
+            if forward and self.next:
+                self.next.put(job)
+            else:
+                self._finish(job)
+
+
+class Pipeline:
+    """Chain of stages, jobs flow from the first to the last one."""
+
+    def __init__(self, stages: list[Stage]) -> None:
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+
+    def on_done(self, callback: Callable[[Job], None]) -> None:
+        """Called once per job, whichever stage it ends in."""
+        for stage in self.stages:
+            stage.on_done = callback
+
+    def submit(self, track: Track) -> Future:
+        job = Job(track)
+        self.stages[0].put(job)
+        return job.future
+
+    def depths(self) -> dict[str, int]:
+        return {stage.name: stage.depth() for stage in self.stages}
+
+    def close(self) -> None:
+        # In order, so that no job is forwarded to a closed stage
+        for stage in self.stages:
+            stage.close()
@@ -0,0 +1,223 @@
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Optional, TextIO
+
+from config import SYNC_PLAYLIST_FOLDER, SYNC_STATE_PATH
+from src.batch import read_queries
+from src.libre_spotify import Librespot
+from src.scheduler import get_scheduler
+from src.spotify_api import SpotifyAPI
+from src.track_dataclass import ILLEGAL_TABLE, Track
+
+
+@dataclass
+class PlaylistState:
+    playlist_id: str
+    name: str
+    snapshot_id: Optional[str]  # None if some tracks failed, to retry them
+    track_ids: list[str]
+
+
+class SyncState:
+    """Snapshot ID and track IDs of each playlist at its last sync,
+    and the tracks downloaded by a sync (the only ones pruned)."""
+
+    def __init__(self, path: Path = SYNC_STATE_PATH) -> None:
+        self.lock = threading.Lock()
+        path.parent.mkdir(exist_ok=True, parents=True)
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS playlists ("
+            "playlist_id TEXT PRIMARY KEY, name TEXT, snapshot_id TEXT, "
+            "track_ids TEXT, updated REAL)"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS downloaded (track_id TEXT PRIMARY KEY)"
+        )
+        self.db.commit()
+
+    def get(self, playlist_id: str) -> Optional[PlaylistState]:
+        with self.lock:
+            row = self.db.execute(
+                "SELECT playlist_id, name, snapshot_id, track_ids FROM playlists "
+                "WHERE playlist_id = ?",
+                (playlist_id,),
+            ).fetchone()
+        if not row:
+            return None
+        return PlaylistState(*row[:3], json.loads(row[3]))
+
+    def put(self, state: PlaylistState) -> None:
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?)",
+                (
+                    state.playlist_id,
+                    state.name,
+                    state.snapshot_id,
+                    json.dumps(state.track_ids),
+                    time.time(),
+                ),
+            )
+            self.db.commit()
+
+    def track_ids(self, exclude: str) -> set[str]:
+        """Tracks of every synced playlist but one."""
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT track_ids FROM playlists WHERE playlist_id != ?", (exclude,)
+            ).fetchall()
+        return {id_ for (track_ids,) in rows for id_ in json.loads(track_ids)}
+
+    def add_downloaded(self, track_ids: set[str]) -> None:
+        with self.lock:
+            self.db.executemany(
+                "INSERT OR IGNORE INTO downloaded VALUES (?)",
+                [(id_,) for id_ in track_ids],
+            )
+            self.db.commit()
+
+    def downloaded(self) -> set[str]:
+        with self.lock:
+            rows = self.db.execute("SELECT track_id FROM downloaded").fetchall()
+        return {track_id for (track_id,) in rows}
+
+    def remove_downloaded(self, track_ids: set[str]) -> None:
+        with self.lock:
+            self.db.executemany(
+                "DELETE FROM downloaded WHERE track_id = ?",
+                [(id_,) for id_ in track_ids],
+            )
+            self.db.commit()
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+class PlaylistSync:
+    """Mirror playlists into the track folder.
+    A playlist whose snapshot ID did not change since its last sync costs
+    a single request. Otherwise only its added tracks are downloaded,
+    and its .m3u8 file is rewritten. With `prune`, the files of removed
+    tracks are deleted if a sync downloaded them, unless another synced
+    playlist has them: tracks downloaded otherwise are never deleted."""
+
+    def __init__(
+        self,
+        ls: Librespot,
+        api: SpotifyAPI,
+        prune: bool = False,
+        state_path: Path = SYNC_STATE_PATH,
+        folder: Path = SYNC_PLAYLIST_FOLDER,
+    ) -> None:
+        self.ls = ls
+        self.api = api
+        self.prune = prune
+        self.state = SyncState(state_path)
+        self.folder = folder
+        self.library = get_scheduler(ls).library
+
+    def sync(self, query: str) -> Optional[bool]:
+        """Returns True if the playlist was synced, False if it was unchanged,
+        None if it is not a playlist."""
+        result = self.api.fetch_id(query)
+        if result.get("type") != "playlist":
+            logging.warning(f"Not a playlist: {query}")
+            return None
+        playlist_id = result["id"]
+        info = self.api.playlist_snapshot(playlist_id)
+        previous = self.state.get(playlist_id)
+        if previous and previous.snapshot_id == info["snapshot_id"]:
+            logging.info(f'"{info["name"]}" unchanged.')
+            return False
+
+        tracks = self.api.get_playlist_tracks(playlist_id, info["snapshot_id"])
+        track_ids = list(dict.fromkeys(track.spotify_id for track in tracks))
+        known = set(previous.track_ids) if previous else set()
+        added = {
+            track.spotify_id: track for track in tracks if track.spotify_id not in known
+        }
+        results = get_scheduler(self.ls).run(added.values()) if added else []
+        failed = {track.spotify_id for track, done in results if done is None}
+        self.state.add_downloaded(
+            {track.spotify_id for track, done in results if done is True}
+        )
+
+        removed = known - set(track_ids)
+        if self.prune and removed:
+            self.prune_(playlist_id, removed)
+        self.write_m3u8_(info["name"], tracks)
+        self.state.put(
+            PlaylistState(
+                playlist_id=playlist_id,
+                name=info["name"],
+                snapshot_id=None if failed else info["snapshot_id"],
+                # Failed tracks are seen as added by the next sync
+                track_ids=[id_ for id_ in track_ids if id_ not in failed],
+            )
+        )
+        logging.info(
+            f'"{info["name"]}" synced: {len(added) - len(failed)} added, '
+            f"{len(removed)} removed{' (pruned)' if self.prune else ''}, "
+            f"{len(failed)} failed."
+        )
+        return True
+
+    def prune_(self, playlist_id: str, track_ids: set[str]) -> None:
+        kept = self.state.track_ids(exclude=playlist_id)
+        pruned = (track_ids & self.state.downloaded()) - kept
+        for track_id in pruned:
+            entry = self.library.get(track_id)
+            if entry:
+                Path(entry.path).unlink(missing_ok=True)
+                self.library.remove(track_id)
+                logging.info(f"Removed {entry.path}")
+        self.state.remove_downloaded(pruned)
+
+    def write_m3u8_(self, name: str, tracks: list[Track]) -> Path:
+        """Playlist file of the downloaded tracks, in the playlist order."""
+        path = self.folder / f"{name.translate(ILLEGAL_TABLE)}.m3u8"
+        lines = ["#EXTM3U"]
+        for track in tracks:
+            entry = self.library.get(track.spotify_id)
+            if not entry:
+                continue
+            lines.append(f"#EXTINF:{round(entry.duration) or -1},{track}")
+            lines.append(Path(os.path.relpath(entry.path, self.folder)).as_posix())
+
+        self.folder.mkdir(exist_ok=True, parents=True)
+        part_path = path.with_name(f"{path.name}.part")
+        part_path.write_text("\n".join(lines) + "\n", encoding="utf-8")
+        os.replace(part_path, path)
+        return path
+
+    def run(self, queries: list[str]) -> dict[str, int]:
+        counts = {"synced": 0, "unchanged": 0, "failed": 0}
+        for query in queries:
+            try:
+                synced = self.sync(query)
+            except Exception as e:
+                logging.error(f"Failed syncing {query}: {e}")
+                synced = None
+            key = {True: "synced", False: "unchanged", None: "failed"}[synced]
+            counts[key] += 1
+        logging.info(f"Sync of {len(queries)} playlists finished: {counts}")
+        return counts
+
+    def close(self) -> None:
+        self.state.close()
+
+
+def run_sync(source: TextIO, ls: Librespot, api: SpotifyAPI, prune: bool) -> None:
+    sync = PlaylistSync(ls, api, prune)
+    try:
+        sync.run(read_queries(source))
+    finally:
+        sync.close()
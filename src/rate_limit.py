@@ -0,0 +1,100 @@
+import logging
+import random
+import threading
+import time
+from typing import Callable, Optional, TypeVar
+
+from config import RATE_LIMITS, RATE_MAX_RETRIES
+
+T = TypeVar("T")
+
+# Returns None if the exception is not a throttling signal,
+# else the delay asked by the server in seconds (0 if unknown)
+RetryHint = Callable[[Exception], Optional[float]]
+
+
+class TokenBucket:
+    """`rate` requests per second on average, with bursts of `burst` requests.
+    The rate adapts: halved when throttled, slowly raised back on success."""
+
+    def __init__(self, rate: float, burst: int) -> None:
+        self.max_rate = rate
+        self.min_rate = rate / 16
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+            time.sleep(wait)
+
+    def throttled(self, delay: float) -> None:
+        with self.lock:
+            self.rate = max(self.min_rate, self.rate / 2)
+            self.tokens = 0
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+    def succeeded(self) -> None:
+        with self.lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 50)
+
+
+class RateGovernor:
+    """Rate limits shared by every thread, per endpoint class
+    (Web API, audio keys..). A throttled request pauses the whole class
+    for the delay given by the server, or an exponential backoff with jitter."""
+
+    def __init__(
+        self,
+        limits: Optional[dict[str, tuple[float, int]]] = None,
+        max_retries: int = RATE_MAX_RETRIES,
+    ) -> None:
+        self.buckets = {
+            kind: TokenBucket(rate, burst)
+            for kind, (rate, burst) in (limits or RATE_LIMITS).items()
+        }
+        self.max_retries = max_retries
+
+    @staticmethod
+    def backoff(attempt: int, base: float = 1.0, cap: float = 120.0) -> float:
+        """Exponential backoff, with jitter so that threads don't retry together."""
+        delay = min(cap, base * 2**attempt)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+    def call(self, kind: str, func: Callable[[], T], retry_hint: RetryHint) -> T:
+        """Call `func` within the rate limits of `kind`,
+        retrying it when `retry_hint` detects a throttling error."""
+        bucket = self.buckets[kind]
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                result = func()
+            except Exception as e:
+                retry_after = retry_hint(e)
+                if retry_after is None or attempt >= self.max_retries:
+                    raise
+                delay = retry_after or self.backoff(attempt)
+                logging.warning(f"Throttled ({kind}), retrying in {delay:.1f} seconds.")
+                bucket.throttled(delay)
+                attempt += 1
+                continue
+
+            bucket.succeeded()
+            return result
+
+
+governor = RateGovernor()
@@ -0,0 +1,179 @@
+import logging
+import queue
+import threading
+from concurrent.futures import Future
+from typing import Callable, Iterable, Optional, Sized
+
+from config import (
+    LOCAL_SEARCH,
+    MAX_CONCURRENT_DOWNLOADS,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_WORKERS,
+    VERIFY_LIBRARY,
+)
+from src.libre_spotify import Librespot
+from src.library_index import LibraryIndex
+from src.metrics import metrics
+from src.pipeline import Job, Pipeline, Stage
+from src.search_index import search_index
+from src.track_dataclass import Track, TrackStream
+from src.tagging import tag_file
+
+# Called with each track and its result, in order
+ResultCallback = Callable[[Track, Optional[bool]], None]
+
+
+class DownloadScheduler:
+    """Download tracks over a shared Librespot session.
+    Each track goes through 4 stages, connected by bounded queues:
+    metadata (library index check) -> resolve (audio key and CDN stream)
+    -> transfer (disk write) -> tag (and index).
+    At most `max_in_flight` tracks are handled at the same time."""
+
+    def __init__(
+        self,
+        ls: Librespot,
+        max_in_flight: int = MAX_CONCURRENT_DOWNLOADS,
+        workers: Optional[dict[str, int]] = None,
+        queue_size: int = PIPELINE_QUEUE_SIZE,
+        library: Optional[LibraryIndex] = None,
+        verify: bool = VERIFY_LIBRARY,
+    ) -> None:
+        self.ls = ls
+        self.library = library or LibraryIndex()
+        self.verify = verify
+        self.slots = threading.BoundedSemaphore(max_in_flight)
+        workers = {**PIPELINE_WORKERS, **(workers or {})}
+        handlers = {
+            "metadata": self.check_track,
+            "resolve": self.resolve_stream,
+            "transfer": self.transfer,
+            "tag": self.tag,
+        }
+        self.pipeline = Pipeline(
+            [
+                Stage(name, handler, workers[name], queue_size)
+                for name, handler in handlers.items()
+            ]
+        )
+        self.pipeline.on_done(lambda job: self.slots.release())
+
+    # Stages
+    def check_track(self, job: Job) -> bool:
+        track = job.track
+        entry = self.library.get(track.spotify_id)
+        # Only a lookup by default: files changed by hand are found by
+        # VERIFY_LIBRARY or --reindex
+        if entry and (not self.verify or self.library.is_complete(entry)):
+            logging.info(f'"{track}" already downloaded, skipping')
+            return False
+
+        if entry:
+            logging.warning(f'"{track}" is missing or incomplete, downloading again')
+            self.library.remove(entry.track_id)
+
+        # Downloaded before the library was indexed
+        elif self.verify and track.get_path().exists():
+            self.library.add(track)
+            logging.info(f'"{track}" already downloaded, skipping')
+            return False
+
+        return True
+
+    def resolve_stream(self, job: Job) -> bool:
+        job.stream = TrackStream.load(job.track, self.ls)
+        if not job.stream:
+            raise RuntimeError("No audio stream found")
+        return True
+
+    def transfer(self, job: Job) -> bool:
+        try:
+            job.stream.store()
+        finally:
+            # The buffered chunks are not needed anymore, even to retry
+            job.stream.release()
+        job.downloaded = True
+        return True
+
+    def tag(self, job: Job) -> bool:
+        stream, job.stream = job.stream, None
+        if not stream.tagged:
+            with metrics.timer("spotifydl_stage_seconds", stage="tag"):
+                tag_file(job.track, stream.path)
+        self.library.add(job.track, stream.path)
+        if LOCAL_SEARCH:
+            search_index.add(job.track, downloaded=True)
+        return True
+
+    def submit(self, track: Track) -> Future:
+        """Queue a track, the returned future resolves once it is tagged.
+        Blocks while too many tracks are in flight."""
+        self.slots.acquire()
+        return self.pipeline.submit(track)
+
+    def run(
+        self, tracks: Iterable[Track], on_result: Optional[ResultCallback] = None
+    ) -> list[tuple[Track, Optional[bool]]]:
+        """Download all tracks concurrently, and return them with their result:
+        True if downloaded, False if skipped, None if failed.
+        Tracks are submitted from a separate thread, so that they can be
+        reported in order while the next ones are still queued.
+        If listing the tracks fails, the error is raised once the tracks
+        already submitted are done."""
+        submitted: queue.Queue = queue.Queue()
+        failed: list[Exception] = []
+
+        def feed() -> None:
+            try:
+                for track in tracks:
+                    submitted.put((track, self.submit(track)))
+            except Exception as e:
+                logging.error(f"Failed listing tracks: {e}")
+                failed.append(e)
+            finally:
+                submitted.put(None)
+
+        threading.Thread(target=feed, name="SpotifyDL-feeder", daemon=True).start()
+
+        total = f"/{len(tracks)}" if isinstance(tracks, Sized) else ""
+        results: list[tuple[Track, Optional[bool]]] = []
+        i = 0
+        while item := submitted.get():
+            track, future = item
+            i += 1
+            progress = f"[{i}{total}]"
+            try:
+                downloaded = future.result()
+            except Exception as e:
+                logging.error(f'{progress} Failed downloading "{track}": {e}')
+                downloaded = None
+            else:
+                if downloaded:
+                    logging.info(f"{progress} Successfully downloaded: {track}")
+
+            result = {True: "downloaded", False: "skipped", None: "failed"}[downloaded]
+            metrics.inc("spotifydl_tracks_total", result=result)
+            results.append((track, downloaded))
+            if on_result:
+                on_result(track, downloaded)
+
+        if failed:
+            raise failed[0]
+        return results
+
+    def shutdown(self) -> None:
+        self.pipeline.close()
+
+
+_shared_scheduler: Optional[DownloadScheduler] = None
+_shared_lock = threading.Lock()
+
+
+def get_scheduler(ls: Librespot) -> DownloadScheduler:
+    """Scheduler shared by every request, so that
+    MAX_CONCURRENT_DOWNLOADS is a global cap."""
+    global _shared_scheduler
+    with _shared_lock:
+        if _shared_scheduler is None:
+            _shared_scheduler = DownloadScheduler(ls)
+        return _shared_scheduler
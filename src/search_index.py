@@ -0,0 +1,144 @@
+import logging
+import re
+import sqlite3
+import threading
+import unicodedata
+from pathlib import Path
+from typing import TYPE_CHECKING, Optional
+
+from config import SEARCH_INDEX_PATH
+
+if TYPE_CHECKING:  # Tracks are indexed once downloaded
+    from src.track_dataclass import Track
+
+
+def tokenize(text: str) -> list[str]:
+    """Lowercase words without accents, like FTS5's unicode61 tokenizer."""
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"\w+", text)
+
+
+class SearchIndex:
+    """Full-text index (SQLite FTS5) of the downloaded tracks and of the
+    tracks found by Web API searches. A query is answered locally when it
+    names the title and an artist of a single indexed track.
+    The database is opened on first use."""
+
+    def __init__(self, path: Path = SEARCH_INDEX_PATH, candidates: int = 20) -> None:
+        self.path = path
+        self.candidates = candidates
+        self.db: Optional[sqlite3.Connection] = None
+        self.enabled = True
+        self.lock = threading.Lock()
+
+    def get_db_(self) -> Optional[sqlite3.Connection]:
+        """Called with the lock held. None if SQLite has no FTS5."""
+        if self.db is None and self.enabled:
+            self.path.parent.mkdir(exist_ok=True, parents=True)
+            db = sqlite3.connect(self.path, check_same_thread=False)
+            try:
+                db.executescript(
+                    """
+                    CREATE TABLE IF NOT EXISTS tracks (
+                        track_id TEXT PRIMARY KEY, album_id TEXT, title TEXT,
+                        artists TEXT, album TEXT, downloaded INTEGER);
+                    CREATE VIRTUAL TABLE IF NOT EXISTS tracks_fts USING fts5(
+                        title, artists, album, content='tracks',
+                        tokenize='unicode61 remove_diacritics 2');
+                    CREATE TRIGGER IF NOT EXISTS tracks_insert AFTER INSERT ON tracks
+                    BEGIN
+                        INSERT INTO tracks_fts (rowid, title, artists, album)
+                        VALUES (new.rowid, new.title, new.artists, new.album);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS tracks_update AFTER UPDATE ON tracks
+                    BEGIN
+                        INSERT INTO tracks_fts
+                            (tracks_fts, rowid, title, artists, album)
+                        VALUES
+                            ('delete', old.rowid, old.title, old.artists, old.album);
+                        INSERT INTO tracks_fts (rowid, title, artists, album)
+                        VALUES (new.rowid, new.title, new.artists, new.album);
+                    END;
+                    """
+                )
+            except sqlite3.OperationalError as e:
+                logging.warning(f"Local search disabled: {e}")
+                db.close()
+                self.enabled = False
+                return None
+            self.db = db
+        return self.db
+
+    def add(
+        self, track: "Track", album_id: Optional[str] = None, downloaded: bool = False
+    ) -> None:
+        """Index a track, or update it. An album ID or the downloaded flag
+        set by a previous call is kept."""
+        with self.lock:
+            db = self.get_db_()
+            if not db:
+                return
+            db.execute(
+                "INSERT INTO tracks VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (track_id) DO UPDATE SET "
+                "album_id = COALESCE(excluded.album_id, album_id), "
+                "title = excluded.title, artists = excluded.artists, "
+                "album = excluded.album, "
+                "downloaded = MAX(downloaded, excluded.downloaded)",
+                (
+                    track.spotify_id,
+                    album_id,
+                    track.title,
+                    "\n".join(track.artists),
+                    track.album,
+                    int(downloaded),
+                ),
+            )
+            db.commit()
+
+    def lookup(self, query: str, album: bool = False) -> Optional[dict]:
+        """ID and type of the single track (or its album) matching a query,
+        as returned by SpotifyAPI.fetch_id. None if no track matches or
+        if several ones do, in which case the Web API decides."""
+        tokens = tokenize(query)
+        if not tokens:
+            return None
+        with self.lock:
+            db = self.get_db_()
+            if not db:
+                return None
+            rows = db.execute(
+                "SELECT t.track_id, t.album_id, t.title, t.artists, t.downloaded "
+                "FROM tracks_fts JOIN tracks t ON t.rowid = tracks_fts.rowid "
+                "WHERE tracks_fts MATCH ? ORDER BY rank LIMIT ?",
+                (" ".join(f'"{token}"' for token in tokens), self.candidates),
+            ).fetchall()
+
+        # Every word of the title and of an artist must be in the query
+        words = set(tokens)
+        matches = [
+            row
+            for row in rows
+            if set(tokenize(row[2])) <= words
+            and any(set(tokenize(artist)) <= words for artist in row[3].split("\n"))
+        ]
+        # Same song on several releases: the downloaded one
+        if len({row[0] for row in matches}) > 1:
+            matches = [row for row in matches if row[4]]
+        if len({row[0] for row in matches}) != 1:
+            return None
+
+        track_id, album_id = matches[0][:2]
+        if album:
+            return {"id": album_id, "type": "album"} if album_id else None
+        return {"id": track_id, "type": "track"}
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db:
+                self.db.close()
+                self.db = None
+
+
+search_index = SearchIndex()
@@ -2,23 +2,41 @@ import asyncio
 import re
 import os
 import logging
-from typing import Optional
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+from typing import TYPE_CHECKING, Callable, Iterable, Iterator, Optional, TypeVar
 from pathlib import Path
 from dotenv import load_dotenv
 
-import spotipy
-from spotipy.oauth2 import SpotifyOauthError
-from spotipy.oauth2 import SpotifyClientCredentials
-from librespot.metadata import TrackId
-
+from config import (
+    ARTIST_INCLUDE_GROUPS,
+    LOCAL_SEARCH,
+    PAGE_FETCH_WORKERS,
+    SPOTIFY_TOKEN_CACHE_FOLDER,
+    VALIDATE_API_ON_STARTUP,
+)
+from src.batch_resolver import BatchResolver
+from src.metadata_cache import MetadataCache, normalize_query
+from src.metrics import metrics
+from src.rate_limit import governor
+from src.search_index import search_index
 from src.track_dataclass import Track
 from src.utils import is_url
 
+if TYPE_CHECKING:  # spotipy is imported on first use, for a faster startup
+    from spotipy.oauth2 import SpotifyClientCredentials
+
 SPOTIFY_URL_REGEX = re.compile(
     r"https?://open\.spotify\.com/(?:(?:intl-[a-z]{2})/)?"
     r"(track|album|playlist|artist)/(?P<ID>[0-9a-zA-Z]{22})",
     re.IGNORECASE,
 )
+T = TypeVar("T")
+
+# Maximum page sizes allowed by the Web API
+ALBUM_PAGE_SIZE = 50
+PLAYLIST_PAGE_SIZE = 100
+ARTIST_ALBUMS_PAGE_SIZE = 50
 
 
 def get_album_name(name) -> str:
@@ -33,6 +51,15 @@ def get_album_name(name) -> str:
     return "?"
 
 
+def get_album_info(album_API: dict) -> dict:
+    """Album fields shared by its tracks."""
+    return {
+        "name": album_API["name"],
+        "cover": album_API["images"][0]["url"] if album_API["images"] else None,
+        "url": album_API["external_urls"]["spotify"],
+    }
+
+
 def get_cover_url(album) -> str:
     """Extract the cover URL from the album information.
     Returns an empty string if no image is found."""
@@ -42,11 +69,38 @@ def get_cover_url(album) -> str:
     return album.get("cover", "")
 
 
+def playlist_items(pages: Iterable[dict]) -> Iterator[dict]:
+    """Tracks of playlist pages, without removed tracks and local files."""
+    for page in pages:
+        for item in page["items"]:
+            if item and item.get("track") and item["track"].get("id"):
+                yield item["track"]
+
+
+def web_api_retry_after(e: Exception) -> Optional[float]:
+    """Delay before retrying a throttled (429) or failed (5xx) request."""
+    from spotipy.exceptions import SpotifyException
+
+    if not isinstance(e, SpotifyException):
+        return None
+    if e.http_status != 429 and e.http_status < 500:
+        return None
+    retry_after = (e.headers or {}).get("Retry-After")
+    try:
+        return float(retry_after) if retry_after else 0.0
+    except ValueError:
+        return 0.0
+
+
 class SpotifyAPI:
     def __init__(self):
         load_dotenv(Path("./.env"), override=True)
         self.client_id = os.getenv("SPOTIPY_CLIENT_ID")
         self.client_secret = os.getenv("SPOTIPY_CLIENT_SECRET")
+        self.cache = MetadataCache()
+        self.resolver = BatchResolver(self)
+        self.valid_app = False
+        self.auth_lock = threading.Lock()
 
     def prompt_tokens(self) -> None:
         self.client_id = input("Spotify client ID: ")
@@ -67,31 +121,77 @@ class SpotifyAPI:
             )
             self.prompt_tokens()
 
-        valid_app = False
-        while not valid_app:
+        import spotipy
+
+        # Retries are handled by the rate governor
+        self.api = spotipy.Spotify(
+            auth_manager=self.auth_manager_(),
+            retries=0,
+            status_retries=0,
+            status_forcelist=(),
+        )
+
+        if VALIDATE_API_ON_STARTUP:
+            # API Request Test
+            await asyncio.to_thread(
+                self.call_, self.api.track, "6kIivltIxJscvk682sTXoV"
+            )
+        else:
+            logging.info("Spotify API ready, credentials are checked on first use.")
+
+    def auth_manager_(self) -> "SpotifyClientCredentials":
+        from spotipy.cache_handler import CacheFileHandler
+        from spotipy.oauth2 import SpotifyClientCredentials
+
+        # One token per app, reused across restarts until it expires
+        SPOTIFY_TOKEN_CACHE_FOLDER.mkdir(exist_ok=True, parents=True)
+        cache_path = SPOTIFY_TOKEN_CACHE_FOLDER / f"{self.client_id}.json"
+        return SpotifyClientCredentials(
+            client_id=self.client_id,
+            client_secret=self.client_secret,
+            cache_handler=CacheFileHandler(cache_path=str(cache_path)),
+        )
+
+    def credentials_checked_(self) -> None:
+        self.valid_app = True
+        with open(".env", "w") as config_file:
+            config_file.write(
+                f"SPOTIPY_CLIENT_ID={self.client_id}"
+                f"\nSPOTIPY_CLIENT_SECRET={self.client_secret}"
+            )
+        logging.info("Connected to Spotify API successfully !")
+
+    def call_(self, func: Callable[..., T], *args, **kwargs) -> T:
+        """Web API request within the shared rate limits.
+        The first request also checks the client credentials."""
+        from spotipy.oauth2 import SpotifyOauthError
+
+        while True:
+            auth_manager = self.api.auth_manager
             try:
-                # Tested API
-                self.api = spotipy.Spotify(
-                    auth_manager=SpotifyClientCredentials(
-                        client_id=self.client_id,
-                        client_secret=self.client_secret,
-                    )
-                )
-                # API Request Test
-                await asyncio.to_thread(self.api.track, "6kIivltIxJscvk682sTXoV")
-                valid_app = True
-                with open(".env", "w") as config_file:
-                    config_file.write(
-                        f"SPOTIPY_CLIENT_ID={self.client_id}"
-                        f"\nSPOTIPY_CLIENT_SECRET={self.client_secret}"
+                with metrics.timer(
+                    "spotifydl_web_api_seconds",
+                    endpoint=getattr(func, "__name__", "?"),
+                ):
+                    result = governor.call(
+                        "web_api", lambda: func(*args, **kwargs), web_api_retry_after
                     )
-                logging.info("Connected to Spotify API successfully !")
-
             except SpotifyOauthError:
-                logging.error(
-                    "Client ID or Client secret is incorrect, please try again."
-                )
-                self.prompt_tokens()
+                with self.auth_lock:
+                    # Only prompt once if several requests failed at the same time
+                    if self.api.auth_manager is auth_manager:
+                        logging.error(
+                            "Client ID or Client secret is incorrect, please try again."
+                        )
+                        self.prompt_tokens()
+                        self.api.auth_manager = self.auth_manager_()
+                continue
+
+            if not self.valid_app:
+                with self.auth_lock:
+                    if not self.valid_app:
+                        self.credentials_checked_()
+            return result
 
     def search(
         self,
@@ -100,9 +200,14 @@ class SpotifyAPI:
         offset: int = 0,
         type: str = "track",
     ) -> list:
-        return self.api.search(query, limit=limit, offset=offset, type=type)[
-            f"{type}s"
-        ]["items"]
+        key = f"{type}:{limit}:{offset}:{normalize_query(query)}"
+        return self.cache.get_or_fetch(
+            "search",
+            key,
+            lambda: self.call_(
+                self.api.search, query, limit=limit, offset=offset, type=type
+            )[f"{type}s"]["items"],
+        )
 
     def fetch_id(
         self,
@@ -116,16 +221,34 @@ class SpotifyAPI:
                 return {"id": m.group("ID"), "type": m.group(1)}
             return {}
 
+        # Tracks already downloaded or found by a previous search
+        if LOCAL_SEARCH:
+            result = search_index.lookup(query, album)
+            if result:
+                metrics.inc("spotifydl_searches_total", source="local")
+                logging.info(f'"{query}" found in the local search index.')
+                return result
+
+        metrics.inc("spotifydl_searches_total", source="web_api")
         items = self.search(query, limit=1)
         if not items:
             return {}
 
         item = items[0]
+        if LOCAL_SEARCH:
+            search_index.add(self.get_track_(item), item["album"]["id"])
         return {
             "id": item["album"]["id"] if album else item["id"],
             "type": "album" if album else "track",
         }
 
+    def prefetch(self, query: str) -> None:
+        """Start fetching the track or album of a URL in the background,
+        so that lookups sent at the same time share multi-ID requests."""
+        result = self.fetch_id(query) if is_url(query, ["open.spotify.com"]) else {}
+        if result.get("type") in {"track", "album"}:
+            self.resolver.get(result["type"], result["id"])
+
     def get_track_(
         self,
         track_api: dict,
@@ -138,7 +261,7 @@ class SpotifyAPI:
         duration = round(track_api["duration_ms"] / 1000)
 
         track = Track(
-            id=TrackId.from_uri(track_api["uri"]),
+            id=track_api["id"],
             title=track_api["name"],
             album=album_name,
             cover_url=cover_url,
@@ -150,58 +273,205 @@ class SpotifyAPI:
 
         return track
 
-    def get_tracks(
+    def iter_pages(
+        self, first_page: dict, fetch_page: Callable[[int], dict]
+    ) -> Iterator[dict]:
+        """Yield the first page, then fetch all the remaining ones concurrently
+        and yield them as soon as they arrive."""
+        yield first_page
+
+        limit = first_page["limit"] or 1
+        offsets = range(first_page["offset"] + limit, first_page["total"], limit)
+        if not offsets:
+            return
+
+        with ThreadPoolExecutor(max_workers=PAGE_FETCH_WORKERS) as executor:
+            futures = [executor.submit(fetch_page, offset) for offset in offsets]
+            for future in as_completed(futures):
+                yield future.result()
+
+    def album_pages_(self, id_: str, album_API: dict) -> Iterator[dict]:
+        """Track pages of an album, the first one being in the album object."""
+        return self.iter_pages(
+            album_API["tracks"],
+            lambda page_offset: self.cache.get_or_fetch(
+                "album_tracks",
+                f"{id_}:{page_offset}",
+                lambda: self.call_(
+                    self.api.album_tracks,
+                    album_id=id_,
+                    limit=ALBUM_PAGE_SIZE,
+                    offset=page_offset,
+                ),
+            ),
+        )
+
+    def artist_discography_(
+        self, id_: str, include_groups: str = ARTIST_INCLUDE_GROUPS
+    ) -> list[Track]:
+        """Tracks of every release of an artist, in the order of the Web API
+        (albums, then singles..). Releases are fetched through multi-ID
+        requests, and a track found on several releases (same ISRC) is only
+        kept from the first one. Tracks of other artists on compilations
+        are left out."""
+
+        def fetch_page(page_offset: int) -> dict:
+            return self.cache.get_or_fetch(
+                "artist_albums",
+                f"{id_}:{include_groups}:{page_offset}",
+                lambda: self.call_(
+                    self.api.artist_albums,
+                    id_,
+                    include_groups=include_groups,
+                    limit=ARTIST_ALBUMS_PAGE_SIZE,
+                    offset=page_offset,
+                ),
+            )
+
+        pages = sorted(
+            self.iter_pages(fetch_page(0), fetch_page), key=lambda page: page["offset"]
+        )
+        album_ids = list(
+            dict.fromkeys(album["id"] for page in pages for album in page["items"])
+        )
+        # Looked up at the same time, so that they share requests
+        albums = [self.resolver.get("album", album_id) for album_id in album_ids]
+        releases = []
+        for album_id, future in zip(album_ids, albums):
+            album_API = future.result()
+            tracks = [
+                track
+                for page in self.album_pages_(album_id, album_API)
+                for track in page["items"]
+                if any(artist["id"] == id_ for artist in track["artists"])
+            ]
+            releases.append((get_album_info(album_API), tracks))
+
+        # Simplified tracks have no ISRC, full ones are fetched 50 at a time
+        full_tracks = {
+            track["id"]: self.resolver.get("track", track["id"])
+            for _, tracks in releases
+            for track in tracks
+        }
+        seen: set[str] = set()
+        discography = []
+        for album_info, tracks in releases:
+            for track in tracks:
+                try:
+                    isrc = full_tracks[track["id"]].result()["external_ids"]["isrc"]
+                except Exception:  # Not found, or no ISRC
+                    isrc = track["id"]
+                if isrc not in seen:
+                    seen.add(isrc)
+                    discography.append(self.get_track_(track, album_info))
+
+        logging.info(
+            f"{len(discography)} tracks in {len(album_ids)} releases "
+            f"({len(full_tracks) - len(discography)} duplicates)."
+        )
+        return discography
+
+    def playlist_pages_(
+        self, id_: str, offset: int = 0, snapshot_id: Optional[str] = None
+    ) -> tuple[int, Iterator[dict]]:
+        """Number of items of a playlist, and its pages in completion order.
+        Pages of a given snapshot are cached apart, as its content can't change."""
+        version = f"{id_}@{snapshot_id}" if snapshot_id else id_
+
+        def fetch_page(page_offset: int) -> dict:
+            return self.cache.get_or_fetch(
+                "playlist",
+                f"{version}:{page_offset}",
+                lambda: self.call_(
+                    self.api.playlist_tracks,
+                    playlist_id=id_,
+                    limit=PLAYLIST_PAGE_SIZE,
+                    offset=page_offset,
+                ),
+            )
+
+        first_page = fetch_page(offset)
+        return first_page["total"], self.iter_pages(first_page, fetch_page)
+
+    def playlist_snapshot(self, id_: str) -> dict:
+        """Name and snapshot ID of a playlist. Never cached: the snapshot ID
+        changes with every edit of the playlist."""
+        return self.call_(self.api.playlist, id_, fields="name,snapshot_id")
+
+    def get_playlist_tracks(
+        self, id_: str, snapshot_id: Optional[str] = None
+    ) -> list[Track]:
+        """All tracks of a playlist, in the playlist order."""
+        _, pages = self.playlist_pages_(id_, snapshot_id=snapshot_id)
+        pages = sorted(pages, key=lambda page: page["offset"])
+        return [self.get_track_(track) for track in playlist_items(pages)]
+
+    def get_tracks_stream(
         self,
         query: Optional[str] = None,
         offset: int = 0,
         album: bool = False,
         id_: Optional[str] = None,
         type: Optional[str] = None,
-    ) -> list[Track]:
+    ) -> tuple[int, Iterator[Track]]:
         """Fetch tracks from a URL or search query.
-        This method can handle tracks, albums, playlists, and artists."""
+        This method can handle tracks, albums, playlists, and artists.
+        Returns the number of tracks, and an iterator yielding them page by page,
+        so that they can be downloaded before the whole list is fetched."""
         if not id_ and not type:
             if not query:
-                return []
+                return 0, iter(())
             result = self.fetch_id(query, album)
             if not result:
-                return []
+                return 0, iter(())
             id_, type = result["id"], result["type"]
 
-        tracks: list[Track] = []
-
         # TRACK
         if type == "track":
-            track_api: dict = self.api.track(track_id=id_)
-            tracks.append(self.get_track_(track_api))
+            track_api: dict = self.resolver.get("track", id_).result()
+            return 1, iter([self.get_track_(track_api)])
 
         # ALBUM
         elif type == "album":
-            album_API: dict = self.api.album(album_id=id_)
-            album_info = {
-                "name": album_API["name"],
-                "cover": album_API["images"][0]["url"] if album_API["images"] else None,
-                "url": album_API["external_urls"]["spotify"],
-            }
-            for track in album_API["tracks"]["items"]:
-                tracks.append(self.get_track_(track, album_info))
+            album_API: dict = self.resolver.get("album", id_).result()
+            album_info = get_album_info(album_API)
+            tracks = (
+                self.get_track_(track, album_info)
+                for page in self.album_pages_(id_, album_API)
+                for track in page["items"]
+            )
+            return album_API["tracks"]["total"], tracks
 
         # PLAYLIST
         elif type == "playlist":
-            playlist_API: dict = self.api.playlist_tracks(
-                playlist_id=id_, offset=offset
-            )
-
-            for item in playlist_API["items"]:
-                if item and "track" in item and item["track"]:
-                    tracks.append(self.get_track_(item["track"]))
+            total, pages = self.playlist_pages_(id_, offset)
+            tracks = (self.get_track_(track) for track in playlist_items(pages))
+            return total - offset, tracks
 
         # ARTIST
+        elif type == "artist" and ARTIST_INCLUDE_GROUPS:
+            tracks = self.artist_discography_(id_)
+            return len(tracks), iter(tracks)
+
         elif type == "artist":
-            artist_API: dict = self.api.artist_top_tracks(
-                artist_id=id_,
+            artist_API: dict = self.cache.get_or_fetch(
+                "artist",
+                id_,
+                lambda: self.call_(self.api.artist_top_tracks, artist_id=id_),
             )
-            for track in artist_API["tracks"]:
-                tracks.append(self.get_track_(track))
+            tracks = [self.get_track_(track) for track in artist_API["tracks"]]
+            return len(tracks), iter(tracks)
 
-        return tracks
+        return 0, iter(())
+
+    def get_tracks(
+        self,
+        query: Optional[str] = None,
+        offset: int = 0,
+        album: bool = False,
+        id_: Optional[str] = None,
+        type: Optional[str] = None,
+    ) -> list[Track]:
+        """Fetch all tracks from a URL or search query."""
+        _, tracks = self.get_tracks_stream(query, offset, album, id_, type)
+        return list(tracks)
@@ -1,52 +1,80 @@
 import logging
 import os
 from pathlib import Path
+from typing import Callable, Iterator, Optional
 
-from config import OPEN_IN_EXPLORER_AFTER_DOWNLOAD, TRACK_FOLDER
+from config import LIBRESPOT_METADATA, OPEN_IN_EXPLORER_AFTER_DOWNLOAD, TRACK_FOLDER
 from src.track_dataclass import Track
 from src.libre_spotify import Librespot
 from src.spotify_api import SpotifyAPI
-from src.utils import tag_ogg_file
+from src.scheduler import ResultCallback, get_scheduler
 
 Path(TRACK_FOLDER).mkdir(exist_ok=True, parents=True)
 
 
-def request(
-    query: str, ls: Librespot, api: SpotifyAPI, ignore_warning: bool = False
-) -> None:
-    tracks: list[Track] = api.get_tracks(query)
-    if len(tracks) > 10 and not ignore_warning:
-        c = input(
-            f"You are about to download {len(tracks)} tracks and may be ratelimited. "
-            "Continue ? (y/n): "
-        )
-        if c.lower() not in {"y", ""}:
-            return
+def resolve_query(
+    query: str, ls: Librespot, api: SpotifyAPI
+) -> tuple[int, Iterator[Track]]:
+    """Number of tracks of a URL or search query, and an iterator over them."""
+    result = api.fetch_id(query)
 
-    if not tracks:
-        logging.warning(f"No tracks found: {query}")
-        return
+    def web_api_stream() -> tuple[int, Iterator[Track]]:
+        return api.get_tracks_stream(id_=result.get("id"), type=result.get("type"))
+
+    if result.get("type") in LIBRESPOT_METADATA:
+        try:
+            total, tracks_stream = ls.get_tracks_stream(result["id"], result["type"])
+            if total:
+                return total, with_fallback(tracks_stream, web_api_stream)
+        except Exception as e:
+            logging.warning(f"Librespot metadata failed ({e}), using the Web API.")
+
+    return web_api_stream()
 
-    for track in tracks:
-        path = track.get_path()
 
-        # Skip if file (with same extension) exists
-        # Simplier but not ideal because that track
-        # could be corrupted and will not be replaced
-        if path.exists():
-            logging.info(f'"{track}" already downloaded, skipping')
-            continue
+def with_fallback(
+    tracks: Iterator[Track], fallback: Callable[[], tuple[int, Iterator[Track]]]
+) -> Iterator[Track]:
+    """Tracks fetched by Librespot, then the remaining ones from the Web API
+    if Librespot fails while listing them."""
+    listed: set[str] = set()
+    try:
+        for track in tracks:
+            listed.add(track.spotify_id)
+            yield track
+    except Exception as e:
+        logging.warning(
+            f"Librespot metadata failed after {len(listed)} tracks ({e}), "
+            "listing the others with the Web API."
+        )
+        _, rest = fallback()
+        yield from (track for track in rest if track.spotify_id not in listed)
+
 
-        # Download
-        track.store_spotify_stream(ls)
-        logging.info(f"Successfully downloaded: {track}")
+def request(
+    query: str,
+    ls: Librespot,
+    api: SpotifyAPI,
+    on_total: Optional[Callable[[int], None]] = None,
+    on_result: Optional[ResultCallback] = None,
+) -> list[tuple[Track, Optional[bool]]]:
+    """Download the tracks of a URL or search query.
+    `on_total` is called with the number of tracks once known,
+    `on_result` with each track and its result, in order."""
+    # No need to confirm large downloads, requests are paced by the rate governor
+    total, tracks_stream = resolve_query(query, ls, api)
+    if on_total:
+        on_total(total)
+    if not total:
+        logging.warning(f"No tracks found: {query}")
+        return []
 
-        # Tag (OGG files only) TODO: add FLAC support
-        match track.ext:
-            case ".ogg":
-                tag_ogg_file(track)
-            case _:
-                logging.warning(f"Tagging not supported for {track.ext} files")
+    # Download and tag concurrently, while the next pages are fetched
+    results = get_scheduler(ls).run(tracks_stream, on_result)
+    tracks: list[Track] = [track for track, _ in results]
+    if not tracks:
+        return results
+    path = tracks[-1].get_path()
 
     if OPEN_IN_EXPLORER_AFTER_DOWNLOAD:
         # Parent folder of the single/album
@@ -60,3 +88,5 @@ def request(
         # Song folder if from multiple sources
         else:
             os.startfile(path.parents[2])
+
+    return results
@@ -0,0 +1,140 @@
+import base64
+import logging
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Optional
+
+from src.cover_cache import cover_cache
+
+if TYPE_CHECKING:  # Tracks write their FLAC header with the stream
+    from src.track_dataclass import Track
+    from src.transfer import ReadableStream
+
+# FLAC metadata block types
+PADDING = 1
+VORBIS_COMMENT = 4
+PICTURE = 6
+# Room left after the tags, so that editing them later does not rewrite the file
+FLAC_PADDING = 4096
+
+
+def vorbis_comments(track: "Track") -> dict[str, str]:
+    """Tags shared by OGG and FLAC files."""
+    return {
+        "title": track.title,
+        "artist": track.artist,
+        "album": track.album,
+        "date": track.date,
+        "tracknumber": str(track.track_number),
+        "discnumber": str(track.disc_number),
+        "spotify_id": track.spotify_id,  # Used to rebuild the library index
+    }
+
+
+def get_picture(track: "Track", width: int = 640, height: int = 640) -> Optional[str]:
+    """Base64 encoded picture block of the album cover,
+    fetched and encoded once per album."""
+    if not track.cover_url:
+        return None
+    return cover_cache.get_picture_block(track.cover_url, width, height)
+
+
+def tag_ogg_file(track: "Track", file_path: Path) -> None:
+    from mutagen.oggvorbis import OggVorbis, OggVorbisHeaderError
+
+    audio = OggVorbis(file_path)
+    audio.update(vorbis_comments(track))
+    picture = get_picture(track)
+    if picture:
+        audio["metadata_block_picture"] = [picture]
+
+    # Save the tags
+    try:
+        audio.save(file_path)
+    except OggVorbisHeaderError as e:
+        logging.debug(f"{track}: {e}")  # Should not impact the output
+
+    logging.info(f'Tagged "{file_path.stem}" successfully.')
+
+
+def tag_flac_file(track: "Track", file_path: Path) -> None:
+    """Used when the tags could not be written with the stream."""
+    from mutagen.flac import FLAC, Picture
+
+    audio = FLAC(file_path)
+    if audio.tags is None:
+        audio.add_tags()
+    audio.tags.update(vorbis_comments(track))
+    picture = get_picture(track)
+    if picture:
+        audio.clear_pictures()
+        audio.add_picture(Picture(base64.b64decode(picture)))
+
+    audio.save(file_path, padding=lambda info: FLAC_PADDING)
+    logging.info(f'Tagged "{file_path.stem}" successfully.')
+
+
+TAGGERS: dict[str, Callable[["Track", Path], None]] = {
+    ".ogg": tag_ogg_file,
+    ".flac": tag_flac_file,
+}
+
+
+def tag_file(track: "Track", file_path: Path) -> None:
+    tagger = TAGGERS.get(file_path.suffix)
+    if tagger:
+        tagger(track, file_path)
+    else:
+        logging.warning(f"Tagging not supported for {file_path.suffix} files")
+
+
+def read_exactly(stream: "ReadableStream", size: int) -> bytes:
+    data = b""
+    while len(data) < size:
+        part = stream.read(size - len(data))
+        if not part:
+            raise EOFError("Truncated FLAC header")
+        data += part
+    return data
+
+
+def flac_header(
+    stream: "ReadableStream", track: "Track", start: int = 0
+) -> Optional[tuple[bytes, int]]:
+    """Metadata blocks of a FLAC stream read from `start`, with the tags and
+    cover of the track instead of the original ones, and the stream position
+    of the first frame. Writing them before the frames tags the file in a
+    single pass.
+    Returns None (and rewinds the stream) if it is not a native FLAC stream."""
+    from mutagen.flac import VCFLACDict
+
+    if stream.read(4) != b"fLaC":
+        stream.seek(start)
+        return None
+
+    blocks = []
+    position = start + 4
+    last = False
+    while not last:
+        block_header = read_exactly(stream, 4)
+        last = bool(block_header[0] & 0x80)
+        block_type = block_header[0] & 0x7F
+        length = int.from_bytes(block_header[1:], "big")
+        data = read_exactly(stream, length)
+        position += 4 + length
+        if block_type not in {PADDING, VORBIS_COMMENT, PICTURE}:
+            blocks.append((block_type, data))
+
+    comments = VCFLACDict()
+    comments.update(vorbis_comments(track))
+    blocks.append((VORBIS_COMMENT, comments.write(framing=False)))
+    picture = get_picture(track)
+    if picture:
+        blocks.append((PICTURE, base64.b64decode(picture)))
+    blocks.append((PADDING, bytes(FLAC_PADDING)))
+
+    header = bytearray(b"fLaC")
+    for i, (block_type, data) in enumerate(blocks):
+        last_flag = 0x80 if i == len(blocks) - 1 else 0
+        header.append(last_flag | block_type)
+        header += len(data).to_bytes(3, "big") + data
+    return bytes(header), position
@@ -1,12 +1,27 @@
 import logging
-from time import sleep
-from dataclasses import dataclass, field
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, replace
 from pathlib import Path
-from typing import Union, Optional, Self, Literal
+from typing import TYPE_CHECKING, Union, Optional, Self, Literal
 
-from config import TRACK_FOLDER, TRY_FLAC_DOWNLOAD
-from src.libre_spotify import Librespot
-from librespot.audio import AbsChunkedInputStream, AudioQualityPicker
+from config import (
+    CHUNK_RETRY_AFTER,
+    CHUNK_TIMEOUT,
+    IN_STREAM_TAGGING,
+    PARALLEL_CHUNKS,
+    PIPELINE_WORKERS,
+    TRACK_FOLDER,
+    TRY_FLAC_DOWNLOAD,
+)
+from src.metrics import metrics
+from src.rate_limit import governor
+from src.tagging import flac_header
+from src.transfer import TransferTimer, copy_chunks, copy_stream
+from librespot.audio import AbsChunkedInputStream, AudioQualityPicker, CdnManager
+from librespot.audio.storage import ChannelManager
 from librespot.metadata import TrackId
 from librespot.structure import FeederException
 from librespot.audio.decoders import (
@@ -15,37 +30,73 @@ from librespot.audio.decoders import (
     VorbisOnlyAudioQuality,
 )
 
+if TYPE_CHECKING:  # Librespot builds Track objects
+    from src.libre_spotify import Librespot
+
 
 PICKERS = {
     "flac": LosslessOnlyAudioQuality(AudioQuality.LOSSLESS),
     "vorbis": VorbisOnlyAudioQuality(AudioQuality.VERY_HIGH),
 }
 
-user_picker = "flac" if TRY_FLAC_DOWNLOAD else "vorbis"
+
+class BestQualityPicker(AudioQualityPicker):
+    """Lossless file if the track has one, else the best Vorbis file.
+    The choice is made from the file list fetched by the load itself,
+    so a track without FLAC file does not need a second load."""
+
+    def __init__(self) -> None:
+        self.lossless = False
+
+    def get_file(self, files):
+        file = PICKERS["flac"].get_file(files)
+        self.lossless = file is not None
+        return file or PICKERS["vorbis"].get_file(files)
+
+
+# Whether the tracks of an album have lossless files, learned from their first
+# track. Only the most recently downloaded albums are kept
+ALBUM_LOSSLESS_ITEMS = 1024
+album_lossless: OrderedDict[str, bool] = OrderedDict()
+album_lossless_lock = threading.Lock()
+
+# Size of the chunks fetched from Spotify's CDN, downloads resume from their bounds
+CHUNK_SIZE = ChannelManager.chunk_size
+
+if PARALLEL_CHUNKS:
+    # Chunks of every stream are fetched by a pool shared by Librespot,
+    # of min(32, CPUs + 4) threads by default
+    CdnManager.Streamer.executor_service = ThreadPoolExecutor(
+        max_workers=PARALLEL_CHUNKS * PIPELINE_WORKERS["transfer"]
+    )
 
 ILLEGAL_CHARS = '/\\?%*:|"<>!'  # Extend as needed
 ILLEGAL_TABLE = str.maketrans({c: "-" for c in ILLEGAL_CHARS})
 
 
-@dataclass()
+@dataclass(frozen=True, slots=True, eq=False)
 class Track:
-    id: TrackId
+    """Metadata of a track to download. Immutable and compared by track ID,
+    so that it can be deduplicated and kept in sets. Its audio stream
+    is held by a TrackStream, only for the time of the download."""
+
+    id: str  # Spotify base62 ID
     title: str = "?"
     artist: str = "?"
-    artists: list[str] = field(default_factory=lambda: ["?"])
+    artists: tuple[str, ...] = ("?",)
     album: str = "?"
     source_url: Optional[str] = None
-    stream_source: Optional[AbsChunkedInputStream] = None
     date: str = ""
     cover_url: str = ""
     duration: Union[str, int, float] = "?"
     track_number: int = 1
     disc_number: int = 1
-    ext: Literal["flac", "ogg"] = "flac"
-    path: Optional[Path] = None  # Where the track should be downloaded
 
     def __eq__(self, other):
-        return self.stream_source == other.stream_source
+        return isinstance(other, Track) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
 
     def __repr__(self):
         return f"{self.artist} - {self.title}"
@@ -56,81 +107,223 @@ class Track:
         else:
             return str(self)
 
+    @property
+    def spotify_id(self) -> str:
+        """Base62 ID, as found in Spotify URLs."""
+        return self.id
+
+    @property
+    def track_id(self) -> TrackId:
+        """Librespot ID, used to load the stream."""
+        return TrackId.from_base62(self.id)
+
+    def to_dict(self) -> dict:
+        """Metadata only, without the stream."""
+        return {
+            "id": self.id,
+            "title": self.title,
+            "artists": list(self.artists),
+            "album": self.album,
+            "source_url": self.source_url,
+            "date": self.date,
+            "cover_url": self.cover_url,
+            "duration": self.duration,
+            "track_number": self.track_number,
+            "disc_number": self.disc_number,
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> Self:
+        data = dict(data)
+        artists = data.pop("artists")
+        return cls(**data).set_artists(artists)
+
     def set_artist(self, artist: str) -> Self:
-        self.artist = artist
-        self.artists = [artist]
-        return self
+        """Copy of the track with a single artist."""
+        return replace(self, artist=artist, artists=(artist,))
 
     def set_artists(self, artists: list) -> Self:
-        if artists:
-            self.artists = artists
-            self.artist = ", ".join(artists)
-        return self
-
-    def set_path(self) -> Self:
-        self.path = TRACK_FOLDER
-        if not TRY_FLAC_DOWNLOAD:
-            self.ext = ".ogg"
-
-        # Path here: songs / artist / album / track
-        for part in [self.artists[0], self.album, f"{self}{self.ext}"]:
-            part = part.translate(ILLEGAL_TABLE)
-            self.path = self.path / part
-
-        return self
-
-    def get_path(self) -> Path:
-        # Fast enough to call it every time
-        # Prevent renaming/ext change issues
-        self.set_path()
-        return self.path
-
-    def load_stream_(
-        self, ls: Librespot, aq_picker: AudioQualityPicker
+        """Copy of the track with its artists, if any."""
+        if not artists:
+            return self
+        return replace(self, artists=tuple(artists), artist=", ".join(artists))
+
+    def get_path(self, ext: Optional[str] = None) -> Path:
+        """Path here: songs / artist / album / track.
+        The extension is known once the stream is loaded, FLAC being tried
+        first with TRY_FLAC_DOWNLOAD."""
+        ext = ext or (".flac" if TRY_FLAC_DOWNLOAD else ".ogg")
+        parts = [self.artists[0], self.album, f"{self}{ext}"]
+        return TRACK_FOLDER.joinpath(*(part.translate(ILLEGAL_TABLE) for part in parts))
+
+
+class TrackStream:
+    """Audio stream of a track, from its loading to the end of its transfer.
+    The source holds every chunk buffered by Librespot,
+    so it is released as soon as the file is written."""
+
+    __slots__ = ("track", "source", "ext", "path", "tagged")
+
+    def __init__(
+        self,
+        track: Track,
+        source: AbsChunkedInputStream,
+        ext: Literal[".flac", ".ogg"],
+    ) -> None:
+        self.track = track
+        self.source: Optional[AbsChunkedInputStream] = source
+        self.ext = ext
+        self.path = track.get_path(ext)  # Where the track is downloaded
+        self.tagged = False  # Tags written with the stream, no need to tag the file
+
+    @staticmethod
+    def load_source_(
+        track: Track, ls: "Librespot", aq_picker: AudioQualityPicker
     ) -> Optional[AbsChunkedInputStream]:
+        def load() -> AbsChunkedInputStream:
+            with ls.acquire() as session:
+                stream = session.content_feeder().load(
+                    track.track_id,
+                    aq_picker,
+                    False,
+                    None,
+                )
+            return stream.input_stream.stream()
+
         try:
-            stream = ls.session.content_feeder().load(
-                self.id,
-                aq_picker,
-                False,
-                None,
-            )
-            self.stream_source = stream.input_stream.stream()
+            # Audio key errors are usually timeouts due to rate limiting
+            with metrics.timer("spotifydl_stage_seconds", stage="audio_key"):
+                return governor.call(
+                    "audio_key",
+                    load,
+                    lambda e: 0.0 if isinstance(e, RuntimeError) else None,
+                )
         except FeederException:  # No suitable audio file found
             return None
-        except RuntimeError:
-            logging.error(
-                f'Failed fetching audio key for "{self}" '
-                "probably due to API timeout, retrying in 60 seconds."
-            )
-            sleep(60)
-            self.load_stream_(ls, aq_picker)
-
-        return self.stream_source
-
-    def generate_stream(self, ls: Librespot) -> AbsChunkedInputStream:
-        self.load_stream_(ls, aq_picker=PICKERS[user_picker])
-        if TRY_FLAC_DOWNLOAD and not self.stream_source:
-            logging.warning(f'FLAC file not found for "{self}", getting OGG stream.')
-            self.ext = ".ogg"
-            self.load_stream_(ls, aq_picker=PICKERS["vorbis"])
-        return self.stream_source
-
-    def store_spotify_stream(self, ls: Optional[Librespot] = None) -> bool:
-        if not self.stream_source:
-            if not ls:
-                logging.error(f'No loaded stream for "{self}": please parse Librespot.')
-                return
-            self.generate_stream(ls)
-
-        # Download
-        path = self.get_path()
+
+    @classmethod
+    def load(cls, track: Track, ls: "Librespot") -> Optional[Self]:
+        """Stream of the best audio file of a track, None if it has none."""
+        album_key = f"{track.artists[0]}/{track.album}"
+        with album_lossless_lock:
+            lossless = album_lossless.get(album_key)
+            if lossless is not None:
+                album_lossless.move_to_end(album_key)
+        if not TRY_FLAC_DOWNLOAD or lossless is False:
+            source = cls.load_source_(track, ls, aq_picker=PICKERS["vorbis"])
+            return cls(track, source, ".ogg") if source else None
+
+        picker = BestQualityPicker()
+        source = cls.load_source_(track, ls, aq_picker=picker)
+        if not source:
+            return None
+        if lossless is None and not picker.lossless:
+            logging.warning(f'No FLAC file for "{track.album}", getting OGG.')
+        with album_lossless_lock:
+            album_lossless[album_key] = picker.lossless
+            album_lossless.move_to_end(album_key)
+            if len(album_lossless) > ALBUM_LOSSLESS_ITEMS:
+                album_lossless.popitem(last=False)
+        return cls(track, source, ".flac" if picker.lossless else ".ogg")
+
+    def store(self) -> bool:
+        # Download to a temporary file, renamed once complete
+        # so that an interrupted download is never seen as finished
+        path = self.path
+        part_path = path.with_name(f"{path.name}.part")
+        # Bytes of the .part file written without holes, when written
+        # by several chunks at once
+        progress_path = path.with_name(f"{path.name}.progress")
         path.parent.mkdir(exist_ok=True, parents=True)
-        with open(path, "wb") as file:
-            while True:
-                data = self.stream_source.read(4096)
-                if not data:
-                    break
-                file.write(data)
+        source = self.source
+        size = source.size()
+        # Librespot skips the Spotify header of the file when loading the stream
+        start = source.pos()
+
+        # FLAC tags are written in the header, before the frames of the stream
+        header, data_start = b"", start
+        if IN_STREAM_TAGGING and self.ext == ".flac":
+            with metrics.timer("spotifydl_stage_seconds", stage="tag"):
+                found = flac_header(source, self.track, start)
+            if found:
+                header, data_start = found
+
+        # Resume from the last complete chunk of an interrupted download
+        offset = data_start  # In the stream
+        if part_path.exists():
+            done = part_path.stat().st_size
+            if progress_path.exists():
+                done = min(done, read_progress(progress_path))
+            done -= len(header)
+            resumed = min(data_start + done, size) // CHUNK_SIZE * CHUNK_SIZE
+            if resumed > data_start and starts_with(part_path, header):
+                logging.info(f'Resuming "{self.track}" download from {resumed} bytes.')
+                offset = resumed
+        source.seek(offset)
+        file_offset = len(header) + offset - data_start
+
+        with (
+            open(part_path, "r+b" if offset > data_start else "wb") as file,
+            TransferTimer(str(self.track)) as timer,
+        ):
+            if offset > data_start:
+                file.truncate(file_offset)
+                file.seek(file_offset)
+            else:
+                file.write(header)
+            if PARALLEL_CHUNKS:
+                file.flush()  # Chunks are written to the file descriptor
+                write_progress(progress_path, file_offset)
+                timer.size = copy_chunks(
+                    source,
+                    file.fileno(),
+                    offset,
+                    file_offset,
+                    CHUNK_SIZE,
+                    PARALLEL_CHUNKS,
+                    CHUNK_TIMEOUT,
+                    CHUNK_RETRY_AFTER,
+                    on_progress=lambda size: write_progress(
+                        progress_path, file_offset + size
+                    ),
+                )
+            else:
+                timer.size = copy_stream(source, file)
+            written = file_offset + timer.size
+
+        expected = len(header) + size - data_start
+        if written != expected:
+            raise OSError(
+                f'Incomplete download for "{self.track}": {written}/{expected} bytes'
+            )
+        os.replace(part_path, path)
+        progress_path.unlink(missing_ok=True)
+        self.tagged = bool(header)
 
         return True
+
+    def release(self) -> None:
+        """Close the source, dropping its buffered chunks."""
+        if self.source is not None:
+            try:
+                self.source.close()
+            except Exception as e:
+                logging.debug(f'Failed closing the stream of "{self.track}": {e}')
+            self.source = None
+
+
+def starts_with(path: Path, prefix: bytes) -> bool:
+    with open(path, "rb") as file:
+        return file.read(len(prefix)) == prefix
+
+
+def read_progress(path: Path) -> int:
+    """Bytes written without holes, 0 if the file was cut while written."""
+    try:
+        return int(path.read_text())
+    except ValueError:
+        return 0
+
+
+def write_progress(path: Path, size: int) -> None:
+    path.write_text(str(size))
@@ -0,0 +1,206 @@
+import logging
+import os
+import time
+from typing import BinaryIO, Callable, Optional, Protocol
+
+from config import (
+    CHUNK_RETRY_AFTER,
+    CHUNK_TIMEOUT,
+    PARALLEL_CHUNKS,
+    TRANSFER_BLOCK_SIZE,
+    TRANSFER_BUFFER_SIZE,
+)
+from src.metrics import metrics
+
+
+class ReadableStream(Protocol):
+    def read(self, size: int) -> bytes: ...
+
+
+class ChunkedStream(ReadableStream, Protocol):
+    """Parts of AbsChunkedInputStream used to fetch chunks out of order."""
+
+    def size(self) -> int: ...
+
+    def chunks(self) -> int: ...
+
+    def buffer(self) -> list[bytes]: ...
+
+    def requested_chunks(self) -> list[bool]: ...
+
+    def available_chunks(self) -> list[bool]: ...
+
+    def request_chunk_from_stream(self, index: int) -> None: ...
+
+
+def copy_stream(
+    stream: ReadableStream,
+    file: BinaryIO,
+    block_size: int = TRANSFER_BLOCK_SIZE,
+    buffer_size: int = TRANSFER_BUFFER_SIZE,
+) -> int:
+    """Copy a stream into a file and return the number of bytes written.
+    Whole blocks are read from the stream and gathered in a preallocated
+    buffer, so that the file is written with a few large writes.
+    Time spent reading (CDN) and writing (disk) is recorded separately."""
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    filled = 0
+    written = 0
+    read_time = write_time = 0.0
+    clock = time.perf_counter
+
+    while True:
+        start = clock()
+        data = stream.read(block_size)
+        read_time += clock() - start
+        if not data:
+            break
+        size = len(data)
+
+        start = clock()
+        if filled + size > buffer_size:
+            file.write(view[:filled])
+            written += filled
+            filled = 0
+        # Too large for the buffer, no need to copy it
+        if size >= buffer_size:
+            file.write(data)
+            written += size
+            write_time += clock() - start
+            continue
+
+        view[filled : filled + size] = data
+        filled += size
+        write_time += clock() - start
+
+    if filled:
+        start = clock()
+        file.write(view[:filled])
+        written += filled
+        write_time += clock() - start
+
+    metrics.observe("spotifydl_stage_seconds", read_time, stage="cdn_read")
+    metrics.observe("spotifydl_stage_seconds", write_time, stage="disk_write")
+    return written
+
+
+def pwrite(fd: int, data: bytes, offset: int) -> None:
+    """Write data at an offset of a file. Falls back to a seek and a write
+    where os.pwrite is missing (Windows), which moves the file position."""
+    view = memoryview(data)
+    while view:
+        if hasattr(os, "pwrite"):
+            written = os.pwrite(fd, view, offset)
+        else:
+            os.lseek(fd, offset, os.SEEK_SET)
+            written = os.write(fd, view)
+        view = view[written:]
+        offset += written
+
+
+def copy_chunks(
+    stream: ChunkedStream,
+    fd: int,
+    offset: int,
+    file_offset: int,
+    chunk_size: int,
+    parallel: int = PARALLEL_CHUNKS,
+    timeout: float = CHUNK_TIMEOUT,
+    retry_after: float = CHUNK_RETRY_AFTER,
+    on_progress: Optional[Callable[[int], None]] = None,
+    poll_interval: float = 0.005,
+) -> int:
+    """Copy a stream from `offset` into a file from `file_offset`,
+    and return the number of bytes written.
+    `parallel` chunks are requested at the same time, Librespot fetching and
+    decrypting them in its own threads. Each chunk is written at its position
+    in the file as soon as it is available, whatever the order, so the file
+    has holes until the end. `on_progress` is called with the number of
+    bytes written without holes from `offset`, whenever it grows."""
+    requested = stream.requested_chunks()
+    available = stream.available_chunks()
+    count = stream.chunks()
+    end = stream.size()
+    next_index = offset // chunk_size
+    pending: list[int] = []
+    requested_at: dict[int, float] = {}
+    complete = 0  # Bytes written before the first pending chunk
+    written = 0
+    write_time = 0.0
+    clock = time.perf_counter
+    start = last_chunk = clock()
+
+    while pending or next_index < count:
+        now = clock()
+        while next_index < count and len(pending) < parallel:
+            pending.append(next_index)
+            requested_at[next_index] = now
+            next_index += 1
+        for index in pending:
+            if requested[index] and now - requested_at[index] < retry_after:
+                continue
+            # Librespot logs and drops the chunks it failed to fetch,
+            # they are requested again once late
+            if requested[index]:
+                logging.debug(f"Chunk {index} late, requesting it again.")
+            requested[index] = True
+            requested_at[index] = now
+            stream.request_chunk_from_stream(index)
+
+        ready = [index for index in pending if available[index]]
+        if not ready:
+            if clock() - last_chunk > timeout:
+                raise TimeoutError(f"No chunk received for {timeout}s")
+            time.sleep(poll_interval)
+            continue
+
+        write_start = clock()
+        for index in ready:
+            skip = max(offset - index * chunk_size, 0)
+            data = memoryview(stream.buffer()[index])[skip:]
+            pwrite(fd, data, file_offset + index * chunk_size + skip - offset)
+            written += len(data)
+            pending.remove(index)
+            requested_at.pop(index)
+        last_chunk = clock()
+        write_time += last_chunk - write_start
+
+        first_missing = min(pending, default=next_index)
+        contiguous = min(first_missing * chunk_size, end) - offset
+        if on_progress and contiguous > complete:
+            on_progress(contiguous)
+        complete = max(complete, contiguous)
+
+    read_time = clock() - start - write_time
+    metrics.observe("spotifydl_stage_seconds", read_time, stage="cdn_read")
+    metrics.observe("spotifydl_stage_seconds", write_time, stage="disk_write")
+    return written
+
+
+class TransferTimer:
+    """Measure the throughput of a transfer."""
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.size = 0
+        self.elapsed = 0.0
+
+    def __enter__(self) -> "TransferTimer":
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.elapsed = time.perf_counter() - self.start
+        if not exc[0]:
+            metrics.observe("spotifydl_transfer_bytes_per_second", self.throughput)
+            metrics.inc("spotifydl_transfer_bytes_total", self.size)
+            logging.info(
+                f'Transferred "{self.name}": {self.size / 1e6:.1f} MB '
+                f"in {self.elapsed:.2f}s ({self.throughput / 1e6:.1f} MB/s)"
+            )
+
+    @property
+    def throughput(self) -> float:
+        """Bytes per second."""
+        return self.size / self.elapsed if self.elapsed else 0.0
@@ -0,0 +1,220 @@
+import json
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Iterator, Optional
+
+from config import (
+    WORK_CLAIM_SIZE,
+    WORK_LEASE_SECONDS,
+    WORK_MAX_ATTEMPTS,
+    WORK_POLL_INTERVAL,
+    WORK_QUEUE_PATH,
+)
+from src.libre_spotify import Librespot
+from src.scheduler import get_scheduler
+from src.spotify_api import SpotifyAPI
+from src.spotify_dl import resolve_query
+from src.track_dataclass import Track
+
+
+class WorkQueue:
+    """Tracks to download, shared by worker processes through a SQLite file.
+    A worker claims a track for `lease_seconds` and extends its lease with
+    heartbeats while downloading it. Tracks of a worker that stopped
+    are claimed again once their lease expires.
+    Each track ID is queued once, so no track is downloaded twice."""
+
+    def __init__(
+        self,
+        path: Path = WORK_QUEUE_PATH,
+        lease_seconds: float = WORK_LEASE_SECONDS,
+        max_attempts: int = WORK_MAX_ATTEMPTS,
+    ) -> None:
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+        path.parent.mkdir(exist_ok=True, parents=True)
+        # Transactions are explicit, so that claims lock the database
+        self.db = sqlite3.connect(
+            path, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS tasks ("
+            "track_id TEXT PRIMARY KEY, data TEXT, status TEXT, worker TEXT, "
+            "lease_until REAL, attempts INTEGER, error TEXT, updated REAL)"
+        )
+        self.db.execute(
+            "CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status, lease_until)"
+        )
+
+    def enqueue(self, tracks: list[Track]) -> int:
+        """Queue tracks, except the ones already queued or done.
+        Returns the number of new tracks."""
+        now = time.time()
+        with self.lock:
+            cursor = self.db.executemany(
+                "INSERT OR IGNORE INTO tasks "
+                "VALUES (?, ?, 'queued', NULL, 0, 0, NULL, ?)",
+                [
+                    (track.spotify_id, json.dumps(track.to_dict()), now)
+                    for track in tracks
+                ],
+            )
+            return cursor.rowcount
+
+    def claim(self, worker: str, limit: int = WORK_CLAIM_SIZE) -> list[Track]:
+        """Lease up to `limit` queued tracks, or tracks whose lease expired.
+        Expired tracks already leased `max_attempts` times are given up."""
+        now = time.time()
+        with self.lock:
+            # Locked before reading, so that two workers can't claim the same rows
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                # Their worker stopped each time (crash, out of memory..)
+                self.db.execute(
+                    "UPDATE tasks SET status = 'failed', error = 'Lease expired', "
+                    "updated = ? WHERE status = 'leased' AND lease_until < ? "
+                    "AND attempts >= ?",
+                    (now, now, self.max_attempts),
+                )
+                rows = self.db.execute(
+                    "SELECT track_id, data FROM tasks WHERE status = 'queued' "
+                    "OR (status = 'leased' AND lease_until < ?) "
+                    "ORDER BY updated LIMIT ?",
+                    (now, limit),
+                ).fetchall()
+                self.db.executemany(
+                    "UPDATE tasks SET status = 'leased', worker = ?, lease_until = ?, "
+                    "attempts = attempts + 1, updated = ? WHERE track_id = ?",
+                    [(worker, now + self.lease_seconds, now, row[0]) for row in rows],
+                )
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return [Track.from_dict(json.loads(data)) for _, data in rows]
+
+    def heartbeat(self, worker: str, track_ids: list[str]) -> None:
+        """Extend the leases of the tracks being downloaded by a worker."""
+        if not track_ids:
+            return
+        now = time.time()
+        with self.lock:
+            self.db.executemany(
+                "UPDATE tasks SET lease_until = ? "
+                "WHERE track_id = ? AND worker = ? AND status = 'leased'",
+                [(now + self.lease_seconds, id_, worker) for id_ in track_ids],
+            )
+
+    def complete(self, worker: str, track_id: str) -> None:
+        with self.lock:
+            self.db.execute(
+                "UPDATE tasks SET status = 'done', updated = ? "
+                "WHERE track_id = ? AND worker = ?",
+                (time.time(), track_id, worker),
+            )
+
+    def fail(self, worker: str, track_id: str, error: str) -> None:
+        """Queue the track again, unless it failed too many times."""
+        with self.lock:
+            self.db.execute(
+                "UPDATE tasks SET error = ?, updated = ?, status = CASE "
+                "WHEN attempts < ? THEN 'queued' ELSE 'failed' END "
+                "WHERE track_id = ? AND worker = ?",
+                (error, time.time(), self.max_attempts, track_id, worker),
+            )
+
+    def release(self, worker: str, track_ids: list[str]) -> None:
+        """Queue again the tracks a stopping worker did not download."""
+        with self.lock:
+            self.db.executemany(
+                "UPDATE tasks SET status = 'queued', attempts = attempts - 1 "
+                "WHERE track_id = ? AND worker = ? AND status = 'leased'",
+                [(id_, worker) for id_ in track_ids],
+            )
+
+    def stats(self) -> dict[str, int]:
+        with self.lock:
+            rows = self.db.execute(
+                "SELECT status, COUNT(*) FROM tasks GROUP BY status"
+            ).fetchall()
+        return dict(rows)
+
+    def close(self) -> None:
+        with self.lock:
+            self.db.close()
+
+
+def enqueue_queries(queries: list[str], ls: Librespot, api: SpotifyAPI) -> int:
+    """Resolve queries and queue their tracks, without downloading them."""
+    queue = WorkQueue()
+    added = 0
+    try:
+        for query in queries:
+            try:
+                _, tracks = resolve_query(query, ls, api)
+                added += queue.enqueue(list(tracks))
+            except Exception as e:
+                logging.error(f"Failed resolving {query}: {e}")
+        logging.info(f"{added} tracks queued, queue: {queue.stats()}")
+    finally:
+        queue.close()
+    return added
+
+
+def run_worker(
+    ls: Librespot,
+    worker: Optional[str] = None,
+    until_empty: bool = False,
+    poll_interval: float = WORK_POLL_INTERVAL,
+) -> None:
+    """Download the queued tracks, claimed as download slots free up.
+    Runs until interrupted, or until the queue is empty with `until_empty`."""
+    worker = worker or f"{socket.gethostname()}-{os.getpid()}"
+    queue = WorkQueue()
+    leased: set[str] = set()
+    lock = threading.Lock()
+    stop = threading.Event()
+    logging.info(f"Worker {worker} started, queue: {queue.stats()}")
+
+    def heartbeat() -> None:
+        while not stop.wait(queue.lease_seconds / 3):
+            with lock:
+                track_ids = list(leased)
+            queue.heartbeat(worker, track_ids)
+
+    def claimed_tracks() -> Iterator[Track]:
+        while not stop.is_set():
+            tracks = queue.claim(worker)
+            if not tracks:
+                if until_empty:
+                    return
+                time.sleep(poll_interval)
+                continue
+            with lock:
+                leased.update(track.spotify_id for track in tracks)
+            yield from tracks
+
+    def on_result(track: Track, downloaded: Optional[bool]) -> None:
+        with lock:
+            leased.discard(track.spotify_id)
+        if downloaded is None:
+            queue.fail(worker, track.spotify_id, "Download failed")
+        else:
+            queue.complete(worker, track.spotify_id)
+
+    threading.Thread(target=heartbeat, name="SpotifyDL-heartbeat", daemon=True).start()
+    try:
+        get_scheduler(ls).run(claimed_tracks(), on_result)
+    finally:
+        stop.set()
+        with lock:
+            queue.release(worker, list(leased))
+        logging.info(f"Worker {worker} stopped, queue: {queue.stats()}")
+        queue.close()